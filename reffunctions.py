@@ -35,22 +35,1736 @@ except:
 #from qgis.core import *
 import qgis
 from qgis.utils import iface,qgsfunction
-from qgis.core import QgsGeometry,QgsExpression,QgsMapLayer,QgsFeatureRequest
+from qgis.PyQt import sip
+from qgis.core import QgsGeometry,QgsExpression,QgsMapLayer,QgsFeatureRequest,QgsSpatialIndex,QgsRectangle
 # Import the code for the dialog
 from .reffunctionsdialog import refFunctionsDialog
 import os.path
 import sys
+import glob
+import time
+import io
+import json
+import inspect
+import cProfile
+import pstats
+import mmap
+import struct
+import hashlib
+import heapq
+import threading
+from collections import OrderedDict, deque
+from functools import wraps
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Layers by name, built once and rebuilt only when project layers are
+# added, removed or renamed instead of on every function call
+_layerSet = None
+_namedLayers = set()
+_projectWatched = False
 
+def _resetLayerSet(*args):
+    global _layerSet
+    _layerSet = None
+
+def _watchProject(watch=True):
+    global _projectWatched
+    if watch == _projectWatched:
+        return
+    project = qgis.core.QgsProject.instance()
+    for signal in (project.layersAdded, project.layersRemoved, project.cleared):
+        if watch:
+            signal.connect(_resetLayerSet)
+        else:
+            signal.disconnect(_resetLayerSet)
+    if watch:
+        project.transformContextChanged.connect(_resetTransforms)
+    else:
+        project.transformContextChanged.disconnect(_resetTransforms)
+    _projectWatched = watch
 
 def _getLayerSet():
-        try:    #qgis 2
-            return {layer.name():layer for layer in iface.legendInterface().layers()}
-        except: #qgis 3
-            return {layer.name():layer for layer in qgis.core.QgsProject.instance().mapLayers().values()}
+    global _layerSet
+    layerSet = _layerSet
+    if layerSet is not None:
+        return layerSet
+    if not _isMainThread():
+        raise _notReady()
+    if _layerSet is None:
+        _watchProject()
+        _layerSet = {}
+        for layer in qgis.core.QgsProject.instance().mapLayers().values():
+            _layerSet[layer.name()] = layer
+            if not layer.id() in _namedLayers:
+                layer.nameChanged.connect(_resetLayerSet)
+                _namedLayers.add(layer.id())
+    return _layerSet
+
+
+# Target field argument resolved once per layer: field indexes, special
+# $geometry/$id names and the attributes and geometry the request needs
+class fieldReference:
+
+    def __init__(self, fields, fieldName):
+        self.fieldName = fieldName
+        self.isGeometry = fieldName == "$geometry"
+        self.isId = fieldName == "$id"
+        self.concatenated = "+" in fieldName
+        self.indexes = [fields.indexOf(name) for name in fieldName.split("+")]
+        self.valid = self.isGeometry or self.isId or all(index >= 0 for index in self.indexes)
+        # index of a single attribute field, -1 otherwise
+        self.index = self.indexes[0] if not self.concatenated and not self.isGeometry and not self.isId else -1
+
+    def request(self, request=None):
+        if request is None:
+            request = QgsFeatureRequest()
+        if self.isGeometry:
+            return request.setNoAttributes()
+        request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+        if self.isId or not self.valid:
+            return request.setNoAttributes()
+        return request.setSubsetOfAttributes(self.indexes)
+
+    def value(self, feat):
+        if self.isGeometry:
+            return _geometryResult(feat.geometry())
+        if self.isId:
+            return feat.id()
+        attributes = feat.attributes()
+        if self.concatenated:
+            # Case of concatenation of several attribute values
+            return " ".join(str(attributes[index]) for index in self.indexes if attributes[index])
+        return attributes[self.index]
+
+_fieldReferences = {}
+
+def _getFieldReference(layer, fieldName):
+    key = (layer.id(), fieldName)
+    if not key in _fieldReferences:
+        _watchLayer(layer)
+        # the new field may have deferred edits
+        _applyDeferredEdits(layer.id())
+        _fieldReferences[key] = fieldReference(_layerState(layer).fields, fieldName)
+    return _fieldReferences[key]
+
+def _fieldsChanged(layerId):
+    with _lock:
+        _layerRevisions[layerId] = _layerRevisions.get(layerId, 0) + 1
+        _dropSources(layerId)
+        for key in [key for key in _fieldReferences if key[0] == layerId]:
+            del _fieldReferences[key]
+        _snapshots.pop(layerId, None)
+
+
+# Layer selected in the canvas, None when running without interface
+def _currentLayer():
+    if iface is None or not _isMainThread():
+        return None
+    return iface.mapCanvas().currentLayer()
+
+# Expressions are also evaluated by render threads (labels, symbology),
+# compound updates of the shared caches are done under _lock
+_lock = threading.RLock()
+
+def _isMainThread():
+    return threading.current_thread() is threading.main_thread()
+
+# Settings are read at most once a second, not on every function call
+_settings = {}
+
+def _setting(key, default):
+    now = time.monotonic()
+    cached = _settings.get(key)
+    if cached is None or now - cached[1] > 1.0:
+        cached = (QSettings().value("refFunctions/" + key, default, type=type(default)), now)
+        _settings[key] = cached
+    return cached[0]
+
+
+# Geometry arguments may be native geometries, WKB or WKT strings
+def _toGeometry(value):
+    if isinstance(value, QgsGeometry):
+        return value
+    if isinstance(value, (bytes, bytearray, QByteArray)):
+        geom = QgsGeometry()
+        geom.fromWkb(bytes(value))
+        return geom
+    return QgsGeometry.fromWkt(value)
+
+# approximate memory held by a decoded geometry
+def _geometryBytes(geom):
+    return geom.constGet().nCoordinates() * 16 + 64 if not geom.isNull() else 64
+
+# Geometry results are WKT strings unless returnGeometries setting is set
+def _geometryResult(geom):
+    if _setting("returnGeometries", False):
+        return QgsGeometry(geom)
+    return geom.asWkt()
+
+
+_DEBUG = False
+
+def _log(string):
+    if _DEBUG:
+        print(string)
+
+
+# Per function call counts, latencies and features scanned/matched,
+# recorded only while enabled from the plugin dialog
+class instrumentation:
+
+    def __init__(self):
+        self.enabled = False
+        # function being evaluated by each thread
+        self.local = threading.local()
+        self.reset()
+
+    @property
+    def current(self):
+        return getattr(self.local, "current", None)
+
+    @current.setter
+    def current(self, name):
+        self.local.current = name
+
+    def reset(self):
+        self.functions = {}
+
+    def _function(self, name):
+        if not name in self.functions:
+            self.functions[name] = {"calls": 0, "time": 0.0, "samples": deque(maxlen=1000), "scanned": 0, "matched": 0}
+        return self.functions[name]
+
+    def record(self, name, elapsed):
+        with _lock:
+            stats = self._function(name)
+            stats["calls"] += 1
+            stats["time"] += elapsed
+            stats["samples"].append(elapsed)
+
+    def addScanned(self, count):
+        if self.enabled and self.current:
+            with _lock:
+                self._function(self.current)["scanned"] += count
+
+    def addMatched(self, count):
+        if self.enabled and self.current:
+            with _lock:
+                self._function(self.current)["matched"] += count
+
+    def report(self):
+        functions = {}
+        with _lock:
+            items = sorted((name, dict(stats, samples=sorted(stats["samples"]))) for name, stats in self.functions.items())
+        for name, stats in items:
+            samples = stats["samples"]
+            percentile = lambda p: samples[int(p * (len(samples) - 1))] * 1000 if samples else 0.0
+            functions[name] = {
+                "calls": stats["calls"],
+                "total_ms": stats["time"] * 1000,
+                "mean_ms": stats["time"] * 1000 / stats["calls"] if stats["calls"] else 0.0,
+                "p50_ms": percentile(0.5),
+                "p90_ms": percentile(0.9),
+                "p99_ms": percentile(0.99),
+                "scanned": stats["scanned"],
+                "matched": stats["matched"],
+            }
+        caches = {}
+        for name, cache in (("geometries", _geometryCache), ("wkt", _wktCache), ("results", _resultMemo)):
+            lookups = cache.hits + cache.misses
+            caches[name] = {"hits": cache.hits, "misses": cache.misses, "hit_rate": cache.hits / lookups if lookups else 0.0}
+        return {"functions": functions, "caches": caches, "memory": _memory.report()}
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+_stats = instrumentation()
+
+# Deterministic profiling of the next evaluation run, armed from the plugin
+# dialog: the run ends when control returns to the event loop, then the
+# hot spots by function, layer and predicate are passed to finished
+class profileSession:
+
+    def __init__(self):
+        self.armed = False
+        self.profiler = None
+        self.hotspots = {}
+        self.finished = None
+
+    def arm(self):
+        self.armed = True
+        self.profiler = None
+
+    def call(self, name, values, function, args):
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.hotspots = {}
+            QTimer.singleShot(0, self.finish)
+        start = time.perf_counter()
+        self.profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            self.profiler.disable()
+            hotspot = self.hotspots.setdefault(_profileTarget(name, values), [0, 0.0])
+            hotspot[0] += 1
+            hotspot[1] += time.perf_counter() - start
+
+    def finish(self):
+        self.armed = False
+        if self.finished:
+            self.finished(self.report())
+
+    def report(self):
+        lines = ["%-60s %8s %10s" % ("function / layer / predicate", "calls", "total ms")]
+        for key, (calls, elapsed) in sorted(self.hotspots.items(), key=lambda item: -item[1][1])[:30]:
+            lines.append("%-60s %8d %10.1f" % (" / ".join(key), calls, elapsed * 1000))
+        stream = io.StringIO()
+        if self.profiler is not None:
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(30)
+        return "\n".join(lines) + "\n\n" + stream.getvalue()
+
+    def save(self, path):
+        self.profiler.dump_stats(path)
+
+_profile = profileSession()
+
+def _profileTarget(name, values):
+    if name.startswith("WKT") or name == "geomRedef" or not values or not isinstance(values[0], str):
+        return (name,)
+    if name == "geomrelate" and len(values) > 2:
+        return (name, values[0], str(values[2]))
+    return (name, values[0])
+
+# Expression functions wrapper recording calls in _stats and _profile, the
+# wrapper always receives the expression context and forwards it when needed
+def _instrumented(function):
+    name = function.__name__
+    usesContext = "context" in inspect.signature(function).parameters
+    @wraps(function)
+    def wrapper(values, feature, parent, context):
+        args = (values, feature, parent, context) if usesContext else (values, feature, parent)
+        try:
+            if not (_stats.enabled or _profile.armed):
+                return function(*args)
+            caller = _stats.current
+            _stats.current = name
+            start = time.perf_counter()
+            try:
+                # the profiler only follows the main thread
+                if _profile.armed and _isMainThread():
+                    return _profile.call(name, values, function, args)
+                return function(*args)
+            finally:
+                if _stats.enabled:
+                    _stats.record(name, time.perf_counter() - start)
+                _stats.current = caller
+        except sourceNotReady:
+            parent.setEvalErrorString("error: targetLayer not ready, evaluated again on next refresh")
+            return None
+    # qgsfunction passes the context according to the wrapper own signature,
+    # not the one of the wrapped function
+    wrapper.__signature__ = inspect.signature(wrapper, follow_wrapped=False)
+    return wrapper
+
+
+# Opt-in memoisation of the reference functions results (memoiseResults
+# setting) for repeated evaluations of the same source feature, by labels,
+# virtual fields or attribute tables. Results are keyed by function,
+# arguments, source layer and feature id and geometry and the revisions of
+# the source and target layers, with LRU eviction under the memoEntries setting.
+# Results with evaluation errors are not kept
+class resultMemo:
+
+    # approximate memory held by an entry, see memoryBudget
+    ENTRY_BYTES = 400
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lastUsed = 0.0
+
+    def clear(self):
+        with _lock:
+            self.entries.clear()
+
+    @property
+    def size(self):
+        return len(self.entries) * self.ENTRY_BYTES
+
+    # drop the least recently used entries until size bytes are freed,
+    # returns the bytes freed
+    def shrink(self, size):
+        freed = 0
+        with _lock:
+            while freed < size and self.entries:
+                self.entries.popitem(last=False)
+                freed += self.ENTRY_BYTES
+        return freed
+
+    # None when the call can not be memoised
+    def key(self, name, values, feature, context):
+        sourceId = context.variable("layer_id") if context is not None else None
+        if not sourceId or not values or not isinstance(values[0], str):
+            return None
+        # results restricted to the visible extent depend on the frame
+        if context.hasVariable("map_extent") and _setting("visibleExtentOnly", False):
+            return None
+        targetLayer = _getLayerSet().get(values[0])
+        if targetLayer is None:
+            return None
+        # edits of both layers must change their revision
+        _watchLayer(targetLayer)
+        if not sourceId in _watchedLayers:
+            if not _isMainThread():
+                return None
+            sourceLayer = qgis.core.QgsProject.instance().mapLayer(sourceId)
+            if sourceLayer is None:
+                return None
+            _watchLayer(sourceLayer)
+        args = tuple(tuple(value) if isinstance(value, list) else value for value in values)
+        # the source geometry may differ from the stored one, e.g. in forms
+        geometry = hash(bytes(feature.geometry().asWkb())) if feature.hasGeometry() else None
+        key = (name, args, sourceId, feature.id(), geometry, _layerRevisions.get(sourceId, 0), _layerRevisions.get(targetLayer.id(), 0))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        with _lock:
+            self.lastUsed = time.monotonic()
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return True, self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def add(self, key, result):
+        maxEntries = _setting("memoEntries", 10000)
+        with _lock:
+            self.entries[key] = result
+            while len(self.entries) > maxEntries:
+                self.entries.popitem(last=False)
+        _memory.added()
+
+_resultMemo = resultMemo()
+
+# Expression functions wrapper returning the memoised results, applied over
+# _instrumented so that statistics only record actual evaluations
+def _memoised(function):
+    @wraps(function)
+    def wrapper(values, feature, parent, context):
+        if not _setting("memoiseResults", False):
+            return function(values, feature, parent, context)
+        try:
+            key = _resultMemo.key(function.__name__, values, feature, context)
+        except sourceNotReady:
+            key = None
+        if key is None:
+            return function(values, feature, parent, context)
+        found, result = _resultMemo.get(key)
+        if found:
+            return result
+        result = function(values, feature, parent, context)
+        if not parent.hasEvalError():
+            _resultMemo.add(key, result)
+        return result
+    wrapper.__signature__ = inspect.signature(wrapper, follow_wrapped=False)
+    return wrapper
+
+
+# Work budgets: features scanned and wall-clock time allowed to a single
+# call (maxFeatures, maxSeconds settings) and to a whole evaluation run
+# (maxRunFeatures, maxRunSeconds settings), 0 meaning no limit.
+# A run is the sequence of calls of a thread sharing the same feedback
+# object or, when the context provides none, the same expression without
+# pauses. A run ends when a feature already evaluated comes again (a new
+# render of the layer), or when its feedback was canceled and the current
+# one is not (a new feedback object at the same address).
+class runBudget:
+
+    def __init__(self, key, feedback):
+        self.key = key
+        # the feedback object itself, its address may be reused by a new one
+        self.feedback = feedback
+        self.start = time.monotonic()
+        self.last = self.start
+        self.scanned = 0
+        self.error = None
+        # features evaluated, when the run has limits
+        self.fids = set()
+        self.lastFid = None
+
+    def ended(self, feedback, fid):
+        if self.error == "error: evaluation canceled" and feedback is not None and not feedback.isCanceled():
+            return True
+        return fid is not None and fid != self.lastFid and fid in self.fids
+
+# current run of each thread, render threads evaluate concurrently
+_runs = threading.local()
+
+def _getRun(key, feedback=None, fid=None):
+    now = time.monotonic()
+    run = getattr(_runs, "current", None)
+    if run is None or run.key != key or now - run.last > 2 or run.ended(feedback, fid):
+        run = _runs.current = runBudget(key, feedback)
+    run.last = now
+    if fid is not None:
+        run.fids.add(fid)
+        run.lastFid = fid
+    return run
+
+class workBudget:
+
+    def __init__(self, parent, context=None):
+        self.parent = parent
+        self.feedback = None
+        if context is not None and hasattr(context, "feedback"):
+            self.feedback = context.feedback()
+        self.maxFeatures = _setting("maxFeatures", 100000)
+        self.maxSeconds = _setting("maxSeconds", 0.0)
+        self.maxRunFeatures = _setting("maxRunFeatures", 0)
+        self.maxRunSeconds = _setting("maxRunSeconds", 0.0)
+        self.start = time.monotonic()
+        self.scanned = 0
+        # features are followed only to end runs with limits
+        fid = None
+        if context is not None and context.hasFeature() and (self.maxRunFeatures or self.maxRunSeconds):
+            fid = context.feature().id()
+        self.run = _getRun(("feedback", sip.unwrapinstance(self.feedback)) if self.feedback else parent.expression(), self.feedback, fid)
+
+    def consume(self, count):
+        _stats.addScanned(count)
+        self.scanned += count
+        self.run.scanned += count
+        return not self.exhausted()
+
+    def exhausted(self):
+        if self.run.error is None:
+            now = time.monotonic()
+            if self.feedback and self.feedback.isCanceled():
+                self.run.error = "error: evaluation canceled"
+            elif self.maxRunFeatures and self.run.scanned > self.maxRunFeatures:
+                self.run.error = "error: too many features compared in this run"
+            elif self.maxRunSeconds and now - self.run.start > self.maxRunSeconds:
+                self.run.error = "error: run time budget exceeded"
+        if self.run.error:
+            self.parent.setEvalErrorString(self.run.error)
+            return True
+        if self.maxFeatures and self.scanned > self.maxFeatures:
+            self.parent.setEvalErrorString("error: too many features to compare")
+            return True
+        if self.maxSeconds and time.monotonic() - self.start > self.maxSeconds:
+            self.parent.setEvalErrorString("error: time budget exceeded")
+            return True
+        return False
+
+
+# Spatial indexes of target layers, shared by all the geom... functions
+# updated on layer edits and rebuilt when the target layer data changes
+_targetIndexes = {}
+_watchedLayers = set()
+
+# Indexes of file based layers saved in a cache directory and reloaded in
+# later sessions while the file is unchanged. Entries are named after the
+# layer source, subset string and index parameters, and stamped with the
+# size and modification time of every file of the dataset. Spatial index entries are fixed size
+# (fid, bounding box) records read through a memory map and bulk loaded,
+# key indexes are JSON lines of [type, value, fid]. Entries are data only,
+# the cache directory may be shared
+class indexStore:
+
+    VERSION = 2
+    RECORD = struct.Struct("<q4d")
+    # JSON storable key types
+    TYPES = {"s": str, "b": bool, "i": int, "f": float}
+
+    def directory(self):
+        return _setting("indexCacheDir", "") or os.path.join(qgis.core.QgsApplication.qgisSettingsDirPath(), "cache", "refFunctions")
+
+    # None for layers without a local file or with pending edits
+    def _stamp(self, layer):
+        if layer.isModified():
+            return None
+        path = layer.dataProvider().dataSourceUri().split("|")[0]
+        if not os.path.isfile(path):
+            return None
+        return self._fileStamp(path)
+
+    # [name, size, modification time] of the file at path and of its
+    # sidecar files sharing its base name: shapefile attributes and index
+    # (.dbf, .shx, .cpg...) may change without the .shp, GeoPackage and
+    # SQLite commits may only touch the write-ahead log
+    def _fileStamp(self, path):
+        base = os.path.splitext(path)[0]
+        files = sorted({path} | set(glob.glob(glob.escape(base) + ".*")) | set(glob.glob(glob.escape(path) + "-*")))
+        try:
+            return [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files if os.path.isfile(f)]
+        except OSError:
+            return None
+
+    # state is the layerState of the layer, stamped with its feature source
+    def _entry(self, state, kind, params):
+        if state is None or state.stamp is None or not _setting("indexCache", True):
+            return None, None
+        name = hashlib.sha1(json.dumps([state.source, state.subsetString, params]).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory(), name + "." + kind), state.stamp
+
+    def _write(self, path, header, data):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            _log("index cache not written: %s" % e)
+
+    def _header(self, f, stamp):
+        try:
+            header = json.loads(f.readline().decode("utf-8"))
+        except ValueError:
+            return None
+        if header.get("version") != self.VERSION or header.get("stamp") != stamp:
+            return None
+        return header
+
+    # (spatial index, all the feature ids, ids of the features without
+    # geometry), None when no valid entry exists
+    def loadBoxes(self, state, maxVertices):
+        path, stamp = self._entry(state, "boxes", ["boxes", maxVertices])
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                header = self._header(f, stamp)
+                if header is None:
+                    return None
+                offset = f.tell()
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            end = offset + header["count"] * self.RECORD.size
+            # records are read by the index from C++, check the size first
+            if len(mapped) < end + 8 * header["empty"]:
+                return None
+            records = (self.RECORD.unpack_from(mapped, position) for position in range(offset, end, self.RECORD.size))
+            ids = set()
+            index = QgsSpatialIndex(qgis.core.QgsFeatureIterator(_boxIterator(records, ids)))
+            # features without geometry
+            empty = set(struct.unpack_from("<%dq" % header["empty"], mapped, end))
+            ids.update(empty)
+        except (struct.error, ValueError, TypeError, KeyError):
+            return None
+        finally:
+            mapped.close()
+        return index, ids, empty
+
+    def saveBoxes(self, state, maxVertices, boxes, empty):
+        path, stamp = self._entry(state, "boxes", ["boxes", maxVertices])
+        if path is None:
+            return
+        data = b"".join(self.RECORD.pack(fid, rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()) for fid, rect in boxes)
+        data += struct.pack("<%dq" % len(empty), *empty)
+        self._write(path, {"version": self.VERSION, "stamp": stamp, "count": len(boxes), "empty": len(empty)}, data)
+
+    # [type, value] of a storable value, None otherwise
+    def encode(self, value):
+        for tag, kind in self.TYPES.items():
+            if type(value) is kind:
+                return [tag, value]
+        return None
+
+    def decode(self, item):
+        tag, value = item
+        kind = self.TYPES[tag]
+        if not (type(value) is kind or kind is float and type(value) is int):
+            raise ValueError("invalid %s value" % tag)
+        return kind(value)
+
+    def loadKeys(self, state, keyFieldName):
+        path, stamp = self._entry(state, "keys", ["keys", keyFieldName])
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                if self._header(f, stamp) is None:
+                    return None
+                ids = {}
+                for line in f:
+                    tag, value, fid = json.loads(line.decode("utf-8"))
+                    if type(fid) is not int:
+                        return None
+                    ids[self.decode([tag, value])] = fid
+                return ids
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+    # key indexes with values of other types are not stored
+    def saveKeys(self, state, keyFieldName, ids):
+        path, stamp = self._entry(state, "keys", ["keys", keyFieldName])
+        if path is None:
+            return
+        lines = []
+        for value, fid in ids.items():
+            item = self.encode(value)
+            if item is None:
+                return
+            lines.append(json.dumps(item + [fid]).encode("utf-8"))
+        self._write(path, {"version": self.VERSION, "stamp": stamp}, b"".join(line + b"\n" for line in lines))
+
+    def clear(self):
+        directory = self.directory()
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith((".boxes", ".keys", ".npy", ".meta", ".tmp")):
+                    os.remove(os.path.join(directory, name))
+
+_indexStore = indexStore()
+
+# Stored (fid, bounding box) records as features for the bulk loading
+# QgsSpatialIndex constructor, the diagonal of each box as geometry keeps
+# degenerate boxes of points and lines
+class _boxIterator(qgis.core.QgsAbstractFeatureIterator):
+
+    # ids receives the feature ids read
+    def __init__(self, records, ids):
+        qgis.core.QgsAbstractFeatureIterator.__init__(self, QgsFeatureRequest())
+        self.records = records
+        self.ids = ids
+
+    def fetchFeature(self, feat):
+        for fid, xmin, ymin, xmax, ymax in self.records:
+            feat.setId(fid)
+            feat.setGeometry(QgsGeometry(qgis.core.QgsLineString([xmin, xmax], [ymin, ymax])))
+            feat.setValid(True)
+            self.ids.add(fid)
+            return True
+        return False
+
+    def rewind(self):
+        return False
+
+    def close(self):
+        return True
+
+
+# Attribute columns of a reference layer as NumPy arrays of (fid, value,
+# null) records sorted by feature id, built on first use by dbvalue and the
+# geom_sum functions when the columnarSnapshots setting is set and NumPy is
+# available. Numeric columns are typed, other columns are dictionary
+# encoded. Columns of file based layers are saved next to the persistent
+# indexes and memory mapped, so they are shared between QGIS processes
+class columnSnapshot:
+
+    NUMERIC = {QVariant.Int: "<i8", QVariant.UInt: "<i8", QVariant.LongLong: "<i8", QVariant.ULongLong: "<u8",
+               QVariant.Double: "<f8", QVariant.Bool: "?"}
+
+    def __init__(self, layer):
+        self.layerId = layer.id()
+        self.columns = {}
+        self.lastUsed = time.monotonic()
+
+    # memory mapped columns are left to the system page cache
+    @property
+    def bytes(self):
+        size = 0
+        for column in list(self.columns.values()):
+            if column is not None:
+                records, values = column
+                size += 0 if isinstance(records, numpy.memmap) else records.nbytes
+                size += len(values) * 64 if values is not None else 0
+        return size
+
+    def isNumeric(self, layer, index):
+        return _layerState(layer).fields.at(index).type() in self.NUMERIC
+
+    # (records, decoded values or None for numeric columns), None when the
+    # column values can not be encoded
+    def column(self, layer, index):
+        if not index in self.columns:
+            state = _layerState(layer)
+            field = state.fields.at(index)
+            path, stamp = _indexStore._entry(state, "column", ["column", field.name(), field.type()])
+            column = self._read(path, stamp) if path is not None else None
+            if column is None:
+                column = self._build(layer, index, field)
+                if path is not None and column is not None:
+                    self._write(path, stamp, column)
+            with _lock:
+                self.columns.setdefault(index, column)
+            _memory.enforce(self)
+        return self.columns[index]
+
+    def _build(self, layer, index, field):
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([index])
+        fids = []
+        data = []
+        nulls = []
+        values = None if field.type() in self.NUMERIC else []
+        codes = {}
+        for feat in _featureSource(layer).getFeatures(request):
+            value = feat.attributes()[index]
+            null = value is None or isinstance(value, QVariant)
+            fids.append(feat.id())
+            nulls.append(null)
+            if values is None:
+                data.append(0 if null else value)
+            elif null:
+                data.append(-1)
+            else:
+                try:
+                    data.append(codes.setdefault(value, len(codes)))
+                except TypeError:
+                    return None
+                if len(codes) > len(values):
+                    values.append(value)
+        dtype = self.NUMERIC[field.type()] if values is None else "<i4"
+        records = numpy.zeros(len(fids), dtype=[("fid", "<i8"), ("value", dtype), ("null", "?")])
+        records["fid"] = fids
+        records["value"] = data
+        records["null"] = nulls
+        records.sort(order="fid")
+        return records, values
+
+    # the .meta file holds the version, stamp and decoded values as JSON
+    def _read(self, path, stamp):
+        try:
+            with open(path + ".meta", "rb") as f:
+                meta = json.loads(f.read().decode("utf-8"))
+            if meta.get("version") != _indexStore.VERSION or meta.get("stamp") != stamp:
+                return None
+            values = meta["values"]
+            if values is not None:
+                values = [_indexStore.decode(item) for item in values]
+            return numpy.load(path + ".npy", mmap_mode="r", allow_pickle=False), values
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+    # columns with values of other types than the key index ones are not saved
+    def _write(self, path, stamp, column):
+        records, values = column
+        if values is not None:
+            values = [_indexStore.encode(value) for value in values]
+            if None in values:
+                return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                numpy.save(f, records)
+            os.replace(path + ".tmp", path + ".npy")
+            # the stamp is written last, a partly written entry stays stale
+            with open(path + ".tmp", "wb") as f:
+                f.write(json.dumps({"version": _indexStore.VERSION, "stamp": stamp, "values": values}).encode("utf-8"))
+            os.replace(path + ".tmp", path + ".meta")
+        except (OSError, ValueError, TypeError) as e:
+            _log("column snapshot not written: %s" % e)
+
+    def _rows(self, records, fids):
+        fids = numpy.asarray(sorted(fids), dtype="<i8")
+        if not len(records) or not len(fids):
+            return numpy.zeros(0, dtype="<i8")
+        rows = numpy.searchsorted(records["fid"], fids).clip(0, len(records) - 1)
+        return rows[records["fid"][rows] == fids]
+
+    # value of feature fid, None when the feature or the column is missing
+    def value(self, layer, index, fid):
+        column = self.column(layer, index)
+        if column is None:
+            return None
+        records, values = column
+        rows = self._rows(records, [fid])
+        if not len(rows):
+            return None
+        record = records[rows[0]]
+        if record["null"]:
+            return qgis.core.NULL
+        value = record["value"].item()
+        return values[value] if values is not None else value
+
+    # sum of the non null values of features fids, None for non numeric columns
+    def sum(self, layer, index, fids):
+        if not self.isNumeric(layer, index):
+            return None
+        records = self.column(layer, index)[0]
+        selected = records[self._rows(records, fids)]
+        return float(selected["value"][~selected["null"]].sum())
+
+_snapshots = {}
+
+def _getSnapshot(layer):
+    if numpy is None or not _setting("columnarSnapshots", False):
+        return None
+    snapshot = _snapshots.get(layer.id())
+    if snapshot is None:
+        _watchLayer(layer)
+        with _lock:
+            snapshot = _snapshots.setdefault(layer.id(), columnSnapshot(layer))
+    snapshot.lastUsed = time.monotonic()
+    return snapshot
+
+
+class targetIndex:
+
+    # approximate memory held by an index entry, see memoryBudget
+    ENTRY_BYTES = 120
+
+    # target geometries with more vertices than subdivideVertices setting
+    # are indexed as subdivided pieces mapped back to the feature id.
+    # When built from given features (e.g. a processing source) instead of a
+    # layer, the geometries are kept by the index itself. A warm-up task
+    # follows the features read from the layer, see warmupTask
+    def __init__(self, layer, features=None, task=None):
+        self.layerId = task.layerId if task is not None else layer.id() if layer is not None else None
+        self.maxVertices = _setting("subdivideVertices", 0)
+        self.index = QgsSpatialIndex()
+        self.pieceIndex = QgsSpatialIndex()
+        self.pieces = {}
+        # number of pieces of each subdivided feature
+        self.subdivided = {}
+        self.ids = set()
+        # ids of the features without geometry
+        self.empty = set()
+        self.kept = None
+        # only the features of an extent, see _getExtentTile
+        self.partial = False
+        # edited features: ids whose main index entries are obsolete, and
+        # current bounding boxes of the added or moved features
+        self.stale = set()
+        self.editBoxes = {}
+        self.editIndex = QgsSpatialIndex()
+        self.bytes = 0
+        self.lastUsed = time.monotonic()
+        boxes = None
+        if features is None:
+            state, source = (task.state, task.source) if task is not None else (_layerState(layer), _featureSource(layer))
+            loaded = _indexStore.loadBoxes(state, self.maxVertices)
+            if loaded is not None:
+                self.index, self.ids, self.empty = loaded
+                self.bytes = len(self.ids) * self.ENTRY_BYTES
+                return
+            features = source.getFeatures(QgsFeatureRequest().setNoAttributes())
+            if task is not None:
+                features = task.track(features)
+            boxes = []
+        else:
+            self.kept = {}
+        for feat in features:
+            self.ids.add(feat.id())
+            if feat.hasGeometry():
+                geom = feat.geometry()
+                if self.kept is not None:
+                    self.kept[feat.id()] = geom
+                    self.bytes += _geometryBytes(geom)
+                if self.maxVertices > 0 and geom.constGet().nCoordinates() > self.maxVertices:
+                    self._addPieces(feat.id(), geom)
+                else:
+                    self.index.addFeature(feat)
+                    if boxes is not None:
+                        boxes.append((feat.id(), geom.boundingBox()))
+            else:
+                self.empty.add(feat.id())
+        self.bytes += len(self.ids) * self.ENTRY_BYTES
+        if task is not None and task.isCanceled():
+            return
+        # subdivided pieces are not stored, they need the geometries
+        if boxes is not None and not self.subdivided:
+            _indexStore.saveBoxes(state, self.maxVertices, boxes, self.empty)
+
+    def _addPieces(self, fid, geom):
+        pieces = geom.subdivide(self.maxVertices).asGeometryCollection()
+        self.subdivided[fid] = len(pieces)
+        for piece in pieces:
+            pieceId = len(self.pieces)
+            self.pieces[pieceId] = (fid, piece)
+            self.pieceIndex.addFeature(pieceId, piece.boundingBox())
+            self.bytes += _geometryBytes(piece) + self.ENTRY_BYTES
+
+    def candidates(self, rect):
+        fids = self.index.intersects(rect)
+        if self.pieces:
+            fids += list({self.pieces[pieceId][0] for pieceId in self.pieceIndex.intersects(rect)})
+        if self.stale:
+            fids = [fid for fid in fids if not fid in self.stale]
+        if self.editBoxes:
+            fids += self.editIndex.intersects(rect)
+        return fids
+
+    # Apply the edit of feature fid, geom is None for a deleted feature.
+    # Returns False when the obsolete entries outgrow the index, which should
+    # then be rebuilt
+    def update(self, fid, geom):
+        if fid in self.editBoxes:
+            del self.editBoxes[fid]
+            editIndex = QgsSpatialIndex()
+            for editId, rect in self.editBoxes.items():
+                editIndex.addFeature(editId, rect)
+            self.editIndex = editIndex
+        elif fid in self.ids:
+            self.stale.add(fid)
+            self.subdivided.pop(fid, None)
+        if geom is None:
+            self.ids.discard(fid)
+            self.empty.discard(fid)
+        else:
+            self.ids.add(fid)
+            if geom.isNull():
+                self.empty.add(fid)
+            else:
+                self.empty.discard(fid)
+                self.editBoxes[fid] = geom.boundingBox()
+                self.editIndex.addFeature(fid, self.editBoxes[fid])
+                self.bytes += self.ENTRY_BYTES
+        return len(self.stale) + len(self.editBoxes) <= max(1000, len(self.ids) // 10)
+
+    # number of the features with a geometry
+    def locatedCount(self):
+        return len(self.ids) - len(self.empty)
+
+    # ids of the features with a geometry not in the set intersecting,
+    # generated lazily
+    def disjointIds(self, intersecting):
+        return (fid for fid in self.ids if not fid in intersecting and not fid in self.empty)
+
+    def geometries(self, layer, fids):
+        if self.kept is None:
+            return _geometryCache.geometries(layer, fids)
+        return {fid: self.kept[fid] for fid in fids if fid in self.kept}
+
+    # ids of the features possibly nearest to geom: the exact distance to the
+    # features nearest to the bounding box center bounds the search rectangle
+    def nearestCandidates(self, layer, geom):
+        center = geom.boundingBox().center()
+        # enough neighbors for one of them not to be obsolete
+        neighbors = 1 + len(self.stale)
+        seeds = self.index.nearestNeighbor(center, neighbors)
+        if self.pieces:
+            seeds += [self.pieces[pieceId][0] for pieceId in self.pieceIndex.nearestNeighbor(center, neighbors)]
+        seeds = [fid for fid in seeds if not fid in self.stale]
+        if self.editBoxes:
+            seeds += self.editIndex.nearestNeighbor(center, 1)
+        seedGeoms = self.geometries(layer, seeds)
+        if not seedGeoms:
+            return []
+        dmax = min(geom.distance(seedGeom) for seedGeom in seedGeoms.values())
+        return sorted(set(self.candidates(geom.boundingBox().buffered(dmax))))
+
+    # within and contains tests of the subdivided features fids decided on
+    # their pieces when possible: geom is within a feature when within one
+    # of its pieces, contains it when it contains all of them, and neither
+    # when it meets none of them. Returns (matching ids, ids left to test
+    # against the whole geometry)
+    def piecePredicate(self, geom, predic, fids):
+        near = {}
+        for pieceId in self.pieceIndex.intersects(geom.boundingBox()):
+            fid, piece = self.pieces[pieceId]
+            if fid in fids:
+                near.setdefault(fid, []).append(piece)
+        matched = set()
+        undecided = set()
+        for fid, pieces in near.items():
+            if predic == "within":
+                if any(geom.within(piece) for piece in pieces):
+                    matched.add(fid)
+                elif any(geom.intersects(piece) for piece in pieces):
+                    undecided.add(fid)
+            elif len(pieces) == self.subdivided[fid]:
+                if all(geom.contains(piece) for piece in pieces):
+                    matched.add(fid)
+                elif all(geom.intersects(piece) for piece in pieces):
+                    undecided.add(fid)
+        return matched, undecided
+
+    def intersectingPieces(self, geom):
+        fids = set()
+        for pieceId in self.pieceIndex.intersects(geom.boundingBox()):
+            fid, piece = self.pieces[pieceId]
+            if not fid in fids and not fid in self.stale and geom.intersects(piece):
+                fids.add(fid)
+        return fids
+
+
+# Hash indexes of the first feature id for each value of a key field,
+# used by dbvalue, updated on added features and rebuilt on other changes
+_keyIndexes = {}
+
+class keyIndex:
+
+    ENTRY_BYTES = 160
+
+    def __init__(self, layer, keyFieldName, features=None, task=None):
+        self.ids = {}
+        self.lastUsed = time.monotonic()
+        stored = features is None
+        if stored:
+            state, source = (task.state, task.source) if task is not None else (_layerState(layer), _featureSource(layer))
+            ids = _indexStore.loadKeys(state, keyFieldName)
+            if ids is not None:
+                self.ids = ids
+                return
+            request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([keyFieldName], state.fields)
+            features = source.getFeatures(request)
+            if task is not None:
+                features = task.track(features)
+        for feat in features:
+            value = feat.attribute(keyFieldName)
+            if isinstance(value, QVariant):
+                continue
+            try:
+                self.ids.setdefault(value, feat.id())
+            except TypeError:
+                pass
+        if stored and not (task is not None and task.isCanceled()):
+            _indexStore.saveKeys(state, keyFieldName, self.ids)
+
+    def get(self, value):
+        try:
+            return self.ids.get(value)
+        except TypeError:
+            return None
+
+    @property
+    def bytes(self):
+        return len(self.ids) * self.ENTRY_BYTES
+
+    # added features only become the first feature of new values
+    def add(self, value, fid):
+        if isinstance(value, QVariant):
+            return
+        try:
+            self.ids.setdefault(value, fid)
+        except TypeError:
+            pass
+
+def _getKeyIndex(layer, keyFieldName):
+    key = (layer.id(), keyFieldName)
+    kIndex = _keyIndexes.get(key)
+    if kIndex is None:
+        _watchLayer(layer)
+        _applyDeferredEdits(layer.id())
+        revision = _layerRevision(layer)
+        kIndex = keyIndex(layer, keyFieldName)
+        with _lock:
+            if _layerRevision(layer) == revision:
+                kIndex = _keyIndexes.setdefault(key, kIndex)
+        _memory.enforce(kIndex)
+    kIndex.lastUsed = time.monotonic()
+    return kIndex
+
+
+# Decoded (and optionally prepared) target geometries, keyed by
+# (layer id, feature id) with LRU eviction under the geometryCacheMB
+# setting, forgotten when the features are edited
+class geometryCache:
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lastUsed = 0.0
+
+    def clear(self):
+        with _lock:
+            self.entries.clear()
+            self.size = 0
+
+    def geometries(self, layer, fids):
+        revision = _layerRevision(layer)
+        res = {}
+        missing = set()
+        with _lock:
+            for fid in fids:
+                key = (layer.id(), fid)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    res[fid] = self.entries[key][0]
+                else:
+                    missing.add(fid)
+            self.hits += len(res)
+            self.misses += len(missing)
+            self.lastUsed = time.monotonic()
+        if missing:
+            for feat in _featureSource(layer).getFeatures(QgsFeatureRequest().setFilterFids(missing).setNoAttributes()):
+                if feat.hasGeometry():
+                    res[feat.id()] = feat.geometry()
+                    self._add((layer.id(), feat.id()), feat.geometry(), revision)
+        return res
+
+    # drop the geometries of layerId features fids, or of all its features
+    def forget(self, layerId, fids=None):
+        with _lock:
+            keys = [key for key in self.entries if key[0] == layerId] if fids is None else [(layerId, fid) for fid in fids]
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[2]
+
+    # drop the least recently used geometries until size bytes are freed,
+    # returns the bytes freed
+    def shrink(self, size):
+        freed = 0
+        with _lock:
+            while freed < size and self.entries:
+                freed += self.entries.popitem(last=False)[1][2]
+            self.size -= freed
+        return freed
+
+    # prepared engines are only used from the main thread, GEOS prepared
+    # geometries can not be shared between threads
+    def engine(self, layer, fid, geom):
+        key = (layer.id(), fid)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._add(key, geom)
+        if entry[1] is None:
+            entry[1] = QgsGeometry.createGeometryEngine(geom.constGet())
+            entry[1].prepareGeometry()
+        return entry[1]
+
+    # geometries read before an edit of the layer are not kept
+    def _add(self, key, geom, revision=None):
+        entry = [geom, None, _geometryBytes(geom)]
+        budget = _setting("geometryCacheMB", 64) * 1024 * 1024
+        with _lock:
+            if revision is not None and _layerRevisions.get(key[0], 0) != revision:
+                return entry
+            self.entries[key] = entry
+            self.size += entry[2]
+            while self.size > budget and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][2]
+        _memory.added()
+        return entry
+
+_geometryCache = geometryCache()
+
+# Revision counters of the layers, increased on every data change
+_layerRevisions = {}
+
+def _layerRevision(layer):
+    return _layerRevisions.get(layer.id(), 0)
+
+def _layerChanged(layerId):
+    with _lock:
+        _layerRevisions[layerId] = _layerRevisions.get(layerId, 0) + 1
+        _targetIndexes.pop(layerId, None)
+        for key in [key for key in _keyIndexes if key[0] == layerId]:
+            del _keyIndexes[key]
+        _snapshots.pop(layerId, None)
+        _dropSources(layerId)
+        _geometryCache.forget(layerId)
+
+# Edit buffer changes update the indexes in place: the feature source is
+# taken again to see the edit buffer, the target index and geometry cache
+# follow added, deleted and moved features, key indexes follow added
+# features and are rebuilt when a key is deleted or changed. Column
+# snapshots are dropped. Commit and rollback rebuild everything since
+# feature ids change
+def _featureEdited(layerId, fid, geom=None, moved=True):
+    with _lock:
+        _layerRevisions[layerId] = _layerRevisions.get(layerId, 0) + 1
+        _dropSources(layerId)
+        _snapshots.pop(layerId, None)
+        if moved:
+            _geometryCache.forget(layerId, [fid])
+            tIndex = _targetIndexes.get(layerId)
+            if tIndex is not None and not tIndex.update(fid, geom):
+                del _targetIndexes[layerId]
+
+def _dropKeyIndexes(layerId, keyFieldName=None):
+    with _lock:
+        for key in [key for key in _keyIndexes if key[0] == layerId and keyFieldName in (None, key[1])]:
+            del _keyIndexes[key]
+
+def _featureAdded(layerId, fid):
+    layer = qgis.core.QgsProject.instance().mapLayer(layerId)
+    feat = layer.getFeature(fid)
+    _featureEdited(layerId, fid, feat.geometry())
+    for key, kIndex in list(_keyIndexes.items()):
+        if key[0] == layerId:
+            kIndex.add(feat.attribute(key[1]), fid)
+
+def _featureDeleted(layerId, fid):
+    _featureEdited(layerId, fid)
+    _dropKeyIndexes(layerId)
+
+# Attribute edits of the fields no function reads (through a field
+# reference, a key index or a dbquery where clause) do not change any result: they are applied
+# once the edits return to the event loop, instead of taking the feature
+# sources again for every edited row of a field calculator run
+_deferredEdits = set()
+
+def _fieldReferenced(layerId, name):
+    with _lock:
+        return (any(key[0] == layerId and name in key[1].split("+") for key in _fieldReferences)
+                or any(key[0] == layerId and key[1] == name for key in _keyIndexes)
+                or any(key[0] == layerId and (name in columns or QgsFeatureRequest.ALL_ATTRIBUTES in columns)
+                       for key, columns in _queryColumns.items()))
+
+def _attributeValueChanged(layerId, fid, index):
+    layer = qgis.core.QgsProject.instance().mapLayer(layerId)
+    name = layer.fields().at(index).name()
+    if _fieldReferenced(layerId, name):
+        _featureEdited(layerId, fid, moved=False)
+    else:
+        with _lock:
+            first = not _deferredEdits
+            _deferredEdits.add(layerId)
+        if first:
+            QTimer.singleShot(0, _applyDeferredEdits)
+    _dropKeyIndexes(layerId, name)
+
+# deferred attribute edits of layerId, or of all the layers
+def _applyDeferredEdits(layerId=None):
+    with _lock:
+        if layerId is None:
+            layerIds = list(_deferredEdits)
+        else:
+            layerIds = [layerId] if layerId in _deferredEdits else []
+        _deferredEdits.difference_update(layerIds)
+    for layerId in layerIds:
+        _featureEdited(layerId, None, moved=False)
+
+# other data changes of a layer being edited come with the edit signals
+def _dataChanged(layerId):
+    layer = qgis.core.QgsProject.instance().mapLayer(layerId)
+    if layer is None or not layer.isEditable():
+        _layerChanged(layerId)
+
+def _layerDeleted(layerId):
+    _layerChanged(layerId)
+    _fieldsChanged(layerId)
+    with _lock:
+        _layerConnections.pop(layerId, None)
+        _watchedLayers.discard(layerId)
+
+# (signal, slot) connections of the watched layers, disconnected on unload
+_layerConnections = {}
+
+def _watchLayer(layer):
+    with _lock:
+        if layer.id() in _watchedLayers:
+            return
+        # signals are connected from the main thread
+        if not _isMainThread():
+            raise _notReady(layer.id())
+        _watchedLayers.add(layer.id())
+    layerId = layer.id()
+    connections = [
+        (layer.dataChanged, lambda: _dataChanged(layerId)),
+        (layer.featureAdded, lambda fid: _featureAdded(layerId, fid)),
+        (layer.featureDeleted, lambda fid: _featureDeleted(layerId, fid)),
+        (layer.geometryChanged, lambda fid, geom: _featureEdited(layerId, fid, geom)),
+        (layer.attributeValueChanged, lambda fid, index, value: _attributeValueChanged(layerId, fid, index)),
+        (layer.afterCommitChanges, lambda: _layerChanged(layerId)),
+        (layer.afterRollBack, lambda: _layerChanged(layerId)),
+        (layer.updatedFields, lambda: _fieldsChanged(layerId)),
+        (layer.crsChanged, lambda: _crsChanged(layerId)),
+        (layer.willBeDeleted, lambda: _layerDeleted(layerId)),
+    ]
+    for signal, slot in connections:
+        signal.connect(slot)
+    with _lock:
+        _layerConnections[layerId] = connections
+
+def _unwatchLayers():
+    with _lock:
+        connections = [connection for layerConnections in _layerConnections.values() for connection in layerConnections]
+        _layerConnections.clear()
+        _watchedLayers.clear()
+    for signal, slot in connections:
+        try:
+            signal.disconnect(slot)
+        except (TypeError, RuntimeError):
+            # layer already deleted
+            pass
+    for layer in qgis.core.QgsProject.instance().mapLayers().values():
+        if layer.id() in _namedLayers:
+            try:
+                layer.nameChanged.disconnect(_resetLayerSet)
+            except (TypeError, RuntimeError):
+                pass
+    _namedLayers.clear()
+
+
+# Target features are read through QgsVectorLayerFeatureSource snapshots,
+# created in the main thread on first use or before each canvas render for
+# the layers already referenced, and taken again after every data change or
+# edit. A feature source is not safe to share between threads: the main
+# thread uses its own one, and every other thread takes one from a pool
+# filled before each render and keeps it until the layer changes. The layer
+# properties the functions need are read along with the main source, render
+# threads never call the layers. A render thread missing a source asks for
+# a new canvas refresh
+_featureSources = {}
+_layerStates = {}
+_sourcePools = {}
+_threadSources = threading.local()
+_wantedSources = set()
+
+class sourceNotReady(Exception):
+    pass
+
+# Layer properties read in the main thread with the feature sources
+class layerState:
+
+    def __init__(self, layer):
+        self.fields = layer.fields()
+        self.crs = layer.crs()
+        self.source = layer.source()
+        self.subsetString = layer.subsetString()
+        self.stamp = _indexStore._stamp(layer)
+        self.transformContext = qgis.core.QgsProject.instance().transformContext()
+
+# exception raised by threads needing layerId to be prepared, or the layer
+# set when layerId is None
+def _notReady(layerId=None):
+    with _lock:
+        refresh = not _wantedSources
+        _wantedSources.add(layerId)
+    if refresh and iface is not None:
+        QMetaObject.invokeMethod(iface.mapCanvas(), "refresh", Qt.QueuedConnection)
+    return sourceNotReady(layerId)
+
+def _featureSource(layer):
+    layerId = layer.id()
+    if _isMainThread():
+        source = _featureSources.get(layerId)
+        if source is None:
+            _watchLayer(layer)
+            _layerStates[layerId] = layerState(layer)
+            source = qgis.core.QgsVectorLayerFeatureSource(layer)
+            _featureSources[layerId] = source
+        return source
+    revision = _layerRevisions.get(layerId, 0)
+    if not hasattr(_threadSources, "sources"):
+        _threadSources.sources = {}
+    entry = _threadSources.sources.get(layerId)
+    if entry is None or entry[0] != revision:
+        with _lock:
+            pool = _sourcePools.get(layerId)
+            source = pool[1].pop() if pool is not None and pool[0] == revision and pool[1] else None
+        if source is None:
+            raise _notReady(layerId)
+        entry = _threadSources.sources[layerId] = (revision, source)
+    return entry[1]
+
+def _layerState(layer):
+    state = _layerStates.get(layer.id())
+    if state is None:
+        if not _isMainThread():
+            raise _notReady(layer.id())
+        _featureSource(layer)
+        state = _layerStates.get(layer.id()) or _layerStates.setdefault(layer.id(), layerState(layer))
+    return state
+
+def _dropSources(layerId):
+    with _lock:
+        _featureSources.pop(layerId, None)
+        _layerStates.pop(layerId, None)
+        _sourcePools.pop(layerId, None)
+
+def _prepareFeatureSources():
+    _getLayerSet()
+    with _lock:
+        layerIds = _watchedLayers | _wantedSources
+        _wantedSources.clear()
+    spare = max(QThread.idealThreadCount(), 1)
+    for layerId in layerIds:
+        layer = qgis.core.QgsProject.instance().mapLayer(layerId) if layerId is not None else None
+        if layer is None or layer.type() != QgsMapLayer.VectorLayer:
+            continue
+        _layerState(layer)
+        revision = _layerRevision(layer)
+        with _lock:
+            pool = _sourcePools.get(layerId)
+            if pool is None or pool[0] != revision:
+                pool = _sourcePools[layerId] = (revision, [])
+            missing = spare - len(pool[1])
+        if missing > 0:
+            sources = [qgis.core.QgsVectorLayerFeatureSource(layer) for i in range(missing)]
+            with _lock:
+                if _sourcePools.get(layerId) is pool:
+                    pool[1].extend(sources)
+
+# Indexes are built outside of _lock, by concurrent threads at worst, and
+# only kept when the layer did not change meanwhile
+def _getTargetIndex(layer, context=None):
+    if context is not None and context.hasVariable("map_extent") and _setting("visibleExtentOnly", False):
+        return _getExtentTile(layer, context.variable("map_extent"), context.variable("map_crs"))
+    tIndex = _targetIndexes.get(layer.id())
+    if tIndex is None:
+        _watchLayer(layer)
+        revision = _layerRevision(layer)
+        tIndex = targetIndex(layer)
+        with _lock:
+            if _layerRevision(layer) == revision:
+                tIndex = _targetIndexes.setdefault(layer.id(), tIndex)
+        _memory.enforce(tIndex)
+    tIndex.lastUsed = time.monotonic()
+    return tIndex
+
+# Visible extent mode (visibleExtentOnly setting): while rendering, the
+# target features intersecting the map extent grown by extentMargin (ratio
+# of the extent size) are read once per frame into a small index shared by
+# all the features drawn in that frame
+_extentTiles = OrderedDict()
+
+def _getExtentTile(layer, extent, mapCrs=None):
+    rect = QgsRectangle(extent.boundingBox())
+    rect.grow(max(rect.width(), rect.height()) * _setting("extentMargin", 0.1))
+    transformKey = ("map:%s" % mapCrs, layer.id())
+    transform = _transforms.get(transformKey, _MISSING)
+    if transform is _MISSING:
+        transform = _crsTransform(transformKey[0], qgis.core.QgsCoordinateReferenceSystem(mapCrs or ""), layer)
+    if transform is not None:
+        try:
+            rect = transform.transformBoundingBox(rect)
+        except qgis.core.QgsCsException:
+            pass
+    key = (layer.id(), _layerRevision(layer), rect.toString())
+    tile = _extentTiles.get(key)
+    if tile is None:
+        _watchLayer(layer)
+        request = QgsFeatureRequest().setFilterRect(rect).setNoAttributes()
+        tile = targetIndex(None, _featureSource(layer).getFeatures(request))
+        tile.partial = True
+        with _lock:
+            tile = _extentTiles.setdefault(key, tile)
+            while len(_extentTiles) > 8:
+                _extentTiles.popitem(last=False)
+        _memory.enforce(tile)
+    tile.lastUsed = time.monotonic()
+    return tile
+
+# Approximate memory held by the indexes, snapshots and caches of the
+# plugin, bounded as a whole by the memoryBudgetMB setting (0 for no
+# budget). Over budget, the structures least recently used are evicted
+# first: whole target, key and extent indexes and column snapshots, while
+# the caches give back their least recently used entries. The budget is
+# checked when a structure is built and every ADD_CHECK cache additions
+class memoryBudget:
+
+    ADD_CHECK = 256
+
+    def __init__(self):
+        self.adds = 0
+        self.evictions = 0
+
+    def budget(self):
+        return _setting("memoryBudgetMB", 0) * 1024 * 1024
+
+    # [(kind, structure, bytes, evict)], evict(size) frees at least size
+    # bytes when it can and returns the bytes freed
+    def _structures(self):
+        def dropper(structures, key, size):
+            return lambda needed: size if structures.pop(key, None) is not None else 0
+        items = []
+        for kind, structures in (("indexes", _targetIndexes), ("indexes", _extentTiles), ("keys", _keyIndexes), ("columns", _snapshots)):
+            for key, structure in list(structures.items()):
+                size = structure.bytes
+                items.append((kind, structure, size, dropper(structures, key, size)))
+        for kind, cache in (("geometries", _geometryCache), ("wkt", _wktCache), ("results", _resultMemo)):
+            items.append((kind, cache, cache.size, cache.shrink))
+        return items
+
+    # bytes held by each kind of structure
+    def usage(self):
+        usage = {}
+        with _lock:
+            for kind, structure, size, evict in self._structures():
+                usage[kind] = usage.get(kind, 0) + size
+        return usage
+
+    def added(self):
+        self.adds += 1
+        if self.adds % self.ADD_CHECK == 0:
+            self.enforce()
+
+    # evict until the budget is met, keep is the structure being used
+    def enforce(self, keep=None):
+        budget = self.budget()
+        if budget <= 0:
+            return
+        with _lock:
+            items = self._structures()
+            total = sum(item[2] for item in items)
+            for kind, structure, size, evict in sorted(items, key=lambda item: item[1].lastUsed):
+                if total <= budget:
+                    break
+                if size and structure is not keep:
+                    freed = evict(total - budget)
+                    if freed:
+                        total -= freed
+                        self.evictions += 1
+
+    def report(self):
+        usage = self.usage()
+        return {"budget": self.budget(), "total": sum(usage.values()), "usage": usage, "evictions": self.evictions}
+
+_memory = memoryBudget()
+
+# Background build of the target index and key indexes of a layer, so that
+# the first evaluation does not pay for it. The layer state and a feature
+# source of its own are taken when the task is created, in the main thread,
+# the task never calls the layer, and the indexes built by
+# the task are swapped in at once when it finishes, unless the layer
+# changed meanwhile. Indexes already built are not built again
+class warmupTask(qgis.core.QgsTask):
+
+    def __init__(self, layer, keyFieldNames=(), spatial=True):
+        qgis.core.QgsTask.__init__(self, "refFunctions indexes of %s" % layer.name(), qgis.core.QgsTask.CanCancel)
+        for keyFieldName in keyFieldNames:
+            if layer.fields().indexOf(keyFieldName) < 0:
+                raise ValueError("field %s not found in %s" % (keyFieldName, layer.name()))
+        self.layerId = layer.id()
+        self.keyFieldNames = list(keyFieldNames)
+        self.spatial = spatial
+        self.setDependentLayers([layer])
+        _watchLayer(layer)
+        self.state = layerState(layer)
+        self.source = qgis.core.QgsVectorLayerFeatureSource(layer)
+        self.revision = _layerRevision(layer)
+        self.total = max(layer.featureCount(), 1) * (int(spatial) + len(self.keyFieldNames))
+        self.read = 0
+        self.tIndex = None
+        self.kIndexes = {}
+        self.error = None
+
+    # features read while not canceled, with the task progress
+    def track(self, features):
+        for feat in features:
+            if self.read % 1000 == 0:
+                if self.isCanceled():
+                    return
+                self.setProgress(min(100.0, self.read * 100.0 / self.total))
+            self.read += 1
+            yield feat
+
+    def run(self):
+        if self.spatial and not self.layerId in _targetIndexes:
+            self.tIndex = targetIndex(None, task=self)
+        for keyFieldName in self.keyFieldNames:
+            if not (self.layerId, keyFieldName) in _keyIndexes:
+                self.kIndexes[keyFieldName] = keyIndex(None, keyFieldName, task=self)
+        return not self.isCanceled()
+
+    def finished(self, result):
+        _warmupTasks.discard(self)
+        if not result:
+            _log("warm-up of %s not completed: %s" % (self.layerId, self.error or "canceled"))
+            return
+        with _lock:
+            if _layerRevisions.get(self.layerId, 0) != self.revision:
+                self.error = "layer changed during the warm-up"
+                return
+            if self.tIndex is not None:
+                _targetIndexes[self.layerId] = self.tIndex
+            for keyFieldName, kIndex in self.kIndexes.items():
+                _keyIndexes[(self.layerId, keyFieldName)] = kIndex
+        _memory.enforce(self.tIndex)
+
+# running tasks, their python part must outlive the call
+_warmupTasks = set()
+
+def warmIndexes(layer, keyFieldNames=(), spatial=True):
+    """
+    Build in background the spatial index of layer (a layer or its name) and
+    the key indexes of its keyFieldNames fields, as used by the geom... and
+    dbvalue functions. Returns the QgsTask added to the QGIS task manager,
+    to be called from the main thread
+    """
+    if isinstance(layer, str):
+        name = layer
+        layer = _getLayerSet().get(name)
+        if layer is None:
+            raise ValueError("layer %s not found" % name)
+    task = warmupTask(layer, keyFieldNames, spatial)
+    _warmupTasks.add(task)
+    qgis.core.QgsApplication.taskManager().addTask(task)
+    return task
+
+# Source geometries are transformed into the target layer CRS when they
+# differ, with a transform cached per (source, target layer) pair, so that
+# target indexes and geometries stay in their native CRS
+# read with a single get, None meaning no transform is needed
+_transforms = {}
+_MISSING = object()
+
+def _resetTransforms(*args):
+    with _lock:
+        _transforms.clear()
+        # layer states hold the transform context
+        _layerStates.clear()
+
+def _crsTransform(sourceKey, sourceCrs, targetLayer):
+    key = (sourceKey, targetLayer.id())
+    transform = _transforms.get(key, _MISSING)
+    if transform is _MISSING:
+        transform = None
+        targetState = _layerState(targetLayer)
+        targetCrs = targetState.crs
+        if sourceCrs.isValid() and targetCrs.isValid() and sourceCrs != targetCrs:
+            transform = qgis.core.QgsCoordinateTransform(sourceCrs, targetCrs, targetState.transformContext)
+        with _lock:
+            _transforms[key] = transform
+    return transform
+
+# source feature geometry in the target layer CRS, None after an eval error
+def _sourceGeometry(feature, targetLayer, context, parent):
+    geom = feature.geometry()
+    sourceId = context.variable("layer_id") if context is not None else None
+    if not sourceId:
+        return geom
+    transform = _transforms.get((sourceId, targetLayer.id()), _MISSING)
+    if transform is _MISSING:
+        sourceState = _layerStates.get(sourceId)
+        if sourceState is None:
+            if not _isMainThread():
+                raise _notReady(sourceId)
+            sourceLayer = qgis.core.QgsProject.instance().mapLayer(sourceId)
+            if sourceLayer is None:
+                return geom
+            sourceState = _layerState(sourceLayer)
+        _watchLayer(targetLayer)
+        transform = _crsTransform(sourceId, sourceState.crs, targetLayer)
+    if transform is None:
+        return geom
+    geom = QgsGeometry(geom)
+    try:
+        geom.transform(transform)
+    except qgis.core.QgsCsException:
+        parent.setEvalErrorString("error: source geometry can not be transformed to the targetLayer CRS")
+        return None
+    return geom
+
+# memoised results of the layer are obsolete too
+def _crsChanged(layerId):
+    with _lock:
+        _layerRevisions[layerId] = _layerRevisions.get(layerId, 0) + 1
+        _dropSources(layerId)
+        for key in [key for key in _transforms if layerId in key]:
+            del _transforms[key]
+
+# Predicates as methods of a prepared target geometry engine, testing target against source.
+# The exact vertex by vertex equals has no engine method, it is always tested on QgsGeometry
+_ENGINE_CONVERSE = {"within": "contains", "contains": "within", "isGeosEqual": "isEqual"}
 
 
 
 @qgsfunction(4, "Reference", register=False)
+@_memoised
+@_instrumented
 def dbvalue(values, feature, parent):
     """
         Retrieve first target_field value from target_layer when condition_field is equal to condition_value
@@ -77,8 +1791,6 @@ def dbvalue(values, feature, parent):
         <div class="notes">The example function is similar to dbquery('myLayer','myTargetField','myKeyField =value') but is significantly faster for large database.
         </div>
     """
-    dbg = debug()
-    dbg.out("evaluating dbvalue")
     targetLayerName = values[0]
     targetFieldName = values[1]
     keyFieldName = values[2]
@@ -92,20 +1804,29 @@ def dbvalue(values, feature, parent):
     #if not targetLayerName in iface.legendInterface().layers():
     #    parent.setEvalErrorString("error: targetLayer not present")
     #iface = QgsInterface.instance()
+    targetLayer = layerSet[targetLayerName]
+    if _layerState(targetLayer).fields.indexOf(keyFieldName) < 0:
+        parent.setEvalErrorString("Error: invalid keyFieldName")
+        return
+    fid = _getKeyIndex(targetLayer, keyFieldName).get(contentCondition)
     res = None
-    for feat in layerSet[targetLayerName].getFeatures():
-        if feat.attribute(keyFieldName) == contentCondition:
-            if targetFieldName == "$geometry":
-                res = feat.geometry().asWkt()
-            else:
-                try:
-                    res = feat.attribute(targetFieldName)
-                except:
-                    parent.setEvalErrorString("Error: invalid targetFieldName")
-                    return
+    if fid is not None:
+        reference = _getFieldReference(targetLayer, targetFieldName)
+        snapshot = _getSnapshot(targetLayer)
+        if snapshot is not None and reference.index >= 0:
+            res = snapshot.value(targetLayer, reference.index, fid)
+            if res is not None:
+                return res
+        for feat in _featureSource(targetLayer).getFeatures(reference.request(QgsFeatureRequest(fid))):
+            if not reference.valid:
+                parent.setEvalErrorString("Error: invalid targetFieldName")
+                return
+            res = reference.value(feat)
     return res
 
 @qgsfunction(3, "Reference", register=False, usesgeometry=True)
+@_memoised
+@_instrumented
 def dbvaluebyid(values, feature, parent):
     """
         Retrieve the target_field value from target_layer using internal feature_id
@@ -128,8 +1849,6 @@ def dbvaluebyid(values, feature, parent):
         <li><code>dbvaluebyid('myLayer','myTargetField',112)</code></li>
         </ul></div>
     """
-    dbg = debug()
-    dbg.out("evaluating dbvalue")
     targetLayerName = values[0]
     targetFieldName = values[1]
     targetFeatureId = values[2]
@@ -142,28 +1861,54 @@ def dbvaluebyid(values, feature, parent):
     #if not targetLayerName in iface.legendInterface().layers():
     #    parent.setEvalErrorString("error: targetLayer not present")
     #iface = QgsInterface.instance()
-    for name,layer in layerSet.items():
-        if name == targetLayerName:
-            try:
-                targetFeatureIter = layer.getFeatures(QgsFeatureRequest(targetFeatureId))
-                for targetFeature in targetFeatureIter:
-                    pass
-            except:
-                parent.setEvalErrorString("Error: invalid targetFeatureIndex")
-                return
-            if targetFieldName == "$geometry":
-                res = targetFeature.geometry().asWkt()
-            else:
-                try:
-                    res = targetFeature.attribute(targetFieldName)
-                except:
-                    parent.setEvalErrorString("Error: invalid targetFieldName")
-                    return
-    return res
-
-
+    layer = layerSet[targetLayerName]
+    reference = _getFieldReference(layer, targetFieldName)
+    targetFeature = None
+    source = _featureSource(layer)
+    try:
+        targetFeatureIter = source.getFeatures(reference.request(QgsFeatureRequest(targetFeatureId)))
+        for targetFeature in targetFeatureIter:
+            pass
+    except:
+        pass
+    if targetFeature is None:
+        parent.setEvalErrorString("Error: invalid targetFeatureIndex")
+        return
+    if not reference.valid:
+        parent.setEvalErrorString("Error: invalid targetFieldName")
+        return
+    return reference.value(targetFeature)
+
+
+
+# Where clauses of dbquery parsed and prepared once per thread and layer
+# state, a prepared expression is not shared between threads. The fields
+# each clause reads are kept for _fieldReferenced
+_queryColumns = {}
+_threadQueries = threading.local()
+
+# (prepared expression, context) of whereClause evaluated on layer features
+def _getQuery(layer, whereClause):
+    key = (layer.id(), whereClause)
+    if not key in _queryColumns:
+        _applyDeferredEdits(layer.id())
+    state = _layerState(layer)
+    if not hasattr(_threadQueries, "queries"):
+        _threadQueries.queries = {}
+    entry = _threadQueries.queries.get(key)
+    if entry is None or entry[0] is not state:
+        context = qgis.core.QgsExpressionContext()
+        context.setFields(state.fields)
+        exp = QgsExpression(whereClause)
+        exp.prepare(context)
+        entry = _threadQueries.queries[key] = (state, exp, context)
+        with _lock:
+            _queryColumns[key] = set(exp.referencedColumns())
+    return entry[1], entry[2]
 
 @qgsfunction(3, "Reference", register=False)
+@_memoised
+@_instrumented
 def dbquery(values, feature, parent):
     """
         Retrieve first target_field value from target_layer when where_clause is true
@@ -197,25 +1942,24 @@ def dbquery(values, feature, parent):
     if not (targetLayerName in layerSet.keys()):
         parent.setEvalErrorString("Error: invalid targetLayerName")
         return
-    dbg=debug()
-    dbg.out("evaluating dbquery")
-
-    for layerName, iterLayer in layerSet.items():
-        if layerName == targetLayerName:
-            exp = QgsExpression(whereClause)
-            exp.prepare(iterLayer.dataProvider().fields())
-            for feat in iterLayer.getFeatures():
-                if exp.evaluate(feature):
-                    if targetFieldName == "$geometry":
-                        return feat.geometry().asWkt()
-                    else:
-                        try:
-                            return feat.attribute(targetFieldName)
-                        except:
-                            parent.setEvalErrorString("Error: invalid targetField")
+
+    iterLayer = layerSet[targetLayerName]
+    reference = _getFieldReference(iterLayer, targetFieldName)
+    exp, context = _getQuery(iterLayer, whereClause)
+    request = QgsFeatureRequest()
+    if not exp.needsGeometry() and not reference.isGeometry:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+    for feat in _featureSource(iterLayer).getFeatures(request):
+        context.setFeature(feat)
+        if exp.evaluate(context):
+            if not reference.valid:
+                parent.setEvalErrorString("Error: invalid targetField")
+                return
+            return reference.value(feat)
 
 
 @qgsfunction(2, "Reference", register=False)
+@_instrumented
 def dbsql(values, feature, parent):
     """
         Retrieve results from SQL query
@@ -239,8 +1983,6 @@ def dbsql(values, feature, parent):
         <li><code>dbsql('myLayer','$geometry','field1 > 1 and field2 = "foo"')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating dbsql")
     connectionName = values[0]
     sqlQuery = values[1].replace('""','@#@')
     sqlQuery = sqlQuery.replace('"',"'")
@@ -248,7 +1990,7 @@ def dbsql(values, feature, parent):
     conn = SQLconnection(connectionName)
     if conn.lastError()=="":
         res = conn.submitQuery(sqlQuery)
-        dbg.out(conn.lastError())
+        _log(conn.lastError())
         if conn.lastError()=="":
             if res!=[]:
                 if len(res)>1 or len(res[0])>1:
@@ -262,7 +2004,40 @@ def dbsql(values, feature, parent):
     else:
         parent.setEvalErrorString("Error: invalid connection")
 
+# Geometry edits of geomRedef, applied in bulk in a single edit command
+# with a single repaint when the evaluation run returns to the event loop.
+# Edits not applied (layer removed or no longer editable meanwhile, feature
+# deleted or edit rejected) are reported
+_pendingGeometries = {}
+
+def _reportDroppedEdits(message):
+    qgis.core.QgsMessageLog.logMessage(message, "refFunctions", qgis.core.Qgis.Warning)
+    if iface is not None:
+        iface.messageBar().pushWarning("refFunctions", message)
+
+def _flushGeometryEdits():
+    for layerId, geometries in _pendingGeometries.items():
+        layer = qgis.core.QgsProject.instance().mapLayer(layerId)
+        if layer is None or not layer.isEditable():
+            _reportDroppedEdits("geomredef: %d geometry edits not applied, layer %s %s" % (
+                len(geometries), layer.name() if layer is not None else layerId,
+                "no longer editable" if layer is not None else "removed"))
+            continue
+        failed = 0
+        layer.beginEditCommand("geomRedef")
+        for fid, geom in geometries.items():
+            if not layer.changeGeometry(fid, geom):
+                failed += 1
+        layer.endEditCommand()
+        layer.updateExtents()
+        layer.triggerRepaint()
+        if failed:
+            _reportDroppedEdits("geomredef: %d of %d geometry edits not applied on layer %s, features deleted or edits rejected" % (
+                failed, len(geometries), layer.name()))
+    _pendingGeometries.clear()
+
 @qgsfunction(1, "Reference", register=False, usesgeometry=True)
+@_instrumented
 def geomRedef(values, feature, parent):
     """
         Redefine the current feature geometry with a new WKT geometry
@@ -275,7 +2050,8 @@ def geomRedef(values, feature, parent):
         <h4>Arguments</h4>
         <div class="arguments">
         <table>
-        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands </td></tr>
+        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands, a WKB geometry or a geometry value.
+        <br/>Edits are applied all together at the end of the evaluation.</td></tr>
         </table>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -283,22 +2059,25 @@ def geomRedef(values, feature, parent):
         <li><code>geomredef('POLYGON((602793.98 6414014.88,....))')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("self redefine geometry")
-    targetGeometry = values[0]
-    if iface.mapCanvas().currentLayer().isEditable():
+    if not _isMainThread():
+        parent.setEvalErrorString("error: geomredef can not be used while rendering")
+        return 0
+    currentLayer = iface.mapCanvas().currentLayer()
+    if currentLayer.isEditable():
         try:
-            iface.mapCanvas().currentLayer().changeGeometry(feature.id(), targetGeometry)
-            #iface.mapCanvas().currentLayer().updateExtents()
-            #iface.mapCanvas().currentLayer().setCacheImage(None)
-            iface.mapCanvas().currentLayer().triggerRepaint()
-            #feature.setGeometry(targetGeometry)
-            return 1
+            targetGeometry = _toGeometry(values[0])
         except:
+            targetGeometry = QgsGeometry()
+        if targetGeometry.isNull():
             parent.setEvalErrorString("Error: geometry is not valid")
             return 0
+        if not _pendingGeometries:
+            QTimer.singleShot(0, _flushGeometryEdits)
+        _pendingGeometries.setdefault(currentLayer.id(), {})[feature.id()] = targetGeometry
+        return 1
 
 @qgsfunction(1, "Reference", register=False)
+@_instrumented
 def xx(values, feature, parent):
     """
         Return the coordinate x of the given point geometry
@@ -316,11 +2095,38 @@ def xx(values, feature, parent):
 
         </p>
     """
-    dbg=debug()
-    dbg.out("xx")
     pass
 
+# Snapshot of the canvas map settings used by the canvas... functions,
+# replaced as a whole on extentsChanged so render threads always read a
+# consistent state without touching iface
+class canvasSnapshot:
+
+    def __init__(self, mapSettings):
+        self.extent = QgsRectangle(mapSettings.visibleExtent())
+        self.width = mapSettings.outputSize().width()
+        self.height = mapSettings.outputSize().height()
+        self.mapUnitsPerPixel = mapSettings.mapUnitsPerPixel()
+
+    # canvas coordinates from the bottom left corner, in pixels
+    def toPixels(self, points):
+        xMin = self.extent.xMinimum()
+        yMin = self.extent.yMinimum()
+        return [(round((point.x()-xMin)/self.mapUnitsPerPixel), round((point.y()-yMin)/self.mapUnitsPerPixel)) for point in points]
+
+_canvasSnapshot = None
+
+def _refreshCanvasSnapshot():
+    global _canvasSnapshot
+    _canvasSnapshot = canvasSnapshot(iface.mapCanvas().mapSettings())
+
+def _getCanvasSnapshot():
+    if _canvasSnapshot is None:
+        _refreshCanvasSnapshot()
+    return _canvasSnapshot
+
 @qgsfunction(1, "Transformation", register=False)
+@_instrumented
 def canvaswidth(values, feature, parent):
     """
         Return the width of the current canvas (in pixels or map units)
@@ -342,22 +2148,16 @@ def canvaswidth(values, feature, parent):
         <li><code>canvas_width('mapunits')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("CanvasWidth")
-    mapCanvas = iface.mapCanvas()
+    snapshot = _getCanvasSnapshot()
     if values[0]=='pixels':
-        res = iface.mapCanvas().mapRenderer().width()
+        return snapshot.width
     elif values[0]=='mapunits':
-        res = iface.mapCanvas().mapRenderer().width()*iface.mapCanvas().mapRenderer().mapUnitsPerPixel ()
-    elif values[0]=='mm':
-        pass
-    try:
-        return res
-    except:
-        parent.setEvalErrorString("error: argument not valid")
+        return snapshot.width*snapshot.mapUnitsPerPixel
+    parent.setEvalErrorString("error: argument not valid")
 
 
 @qgsfunction(1, "Transformation", register=False)
+@_instrumented
 def canvasheight(values, feature, parent):
     """
         Return the height of the current canvas (in pixels or map units)
@@ -379,21 +2179,15 @@ def canvasheight(values, feature, parent):
         <li><code>canvas_height('mapunits')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("CanvasHeight")
-    mapCanvas = iface.mapCanvas()
+    snapshot = _getCanvasSnapshot()
     if values[0]=='pixels':
-        res = iface.mapCanvas().mapRenderer().height()
+        return snapshot.height
     elif values[0]=='mapunits':
-        res = iface.mapCanvas().mapRenderer().height()*iface.mapCanvas().mapRenderer().mapUnitsPerPixel ()
-    elif values[0]=='mm':
-        pass
-    try:
-        return res
-    except:
-        parent.setEvalErrorString("error: argument not valid")
+        return snapshot.height*snapshot.mapUnitsPerPixel
+    parent.setEvalErrorString("error: argument not valid")
 
 @qgsfunction(0, "Transformation", register=False, usesgeometry=True)
+@_instrumented
 def canvasx(values, feature, parent):
     """
         Return the height of the current canvas (in pixels or map units)
@@ -415,19 +2209,15 @@ def canvasx(values, feature, parent):
         <li><code>canvas_height('mapunits')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("canvasx")
-    if iface.mapCanvas().mapRenderer().extent().intersects(feature.geometry().boundingBox()):
-        leftX = iface.mapCanvas().mapRenderer().extent().xMinimum()
-        featX = feature.geometry().pointOnSurface ().boundingBox().xMinimum()
-        dbg.out(leftX)
-        dbg.out(featX)
-        canvasX = round ((featX-leftX)/iface.mapCanvas().mapRenderer().mapUnitsPerPixel())
+    snapshot = _getCanvasSnapshot()
+    if snapshot.extent.intersects(feature.geometry().boundingBox()):
+        canvasX, canvasY = snapshot.toPixels([feature.geometry().pointOnSurface().asPoint()])[0]
         return canvasX
     else:
         return
 
 @qgsfunction(0, "Transformation", register=False, usesgeometry=True)
+@_instrumented
 def canvasy(values, feature, parent):
     """
         Return the height of the current canvas (in pixels or map units)
@@ -449,20 +2239,72 @@ def canvasy(values, feature, parent):
         <li><code>canvas_height('mapunits')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("canvasy")
-    if iface.mapCanvas().mapRenderer().extent().intersects(feature.geometry().boundingBox()):
-        bottomY = iface.mapCanvas().mapRenderer().extent().yMinimum()
-        featY = feature.geometry().pointOnSurface ().boundingBox().yMinimum()
-        dbg.out(bottomY)
-        dbg.out(featY)
-        canvasY = round ((featY-bottomY)/iface.mapCanvas().mapRenderer().mapUnitsPerPixel())
+    snapshot = _getCanvasSnapshot()
+    if snapshot.extent.intersects(feature.geometry().boundingBox()):
+        canvasX, canvasY = snapshot.toPixels([feature.geometry().pointOnSurface().asPoint()])[0]
         return canvasY
     else:
         return
 
 
+# Parsed WKT/WKB geometries and the results computed on them, shared by the
+# WKT... functions and bounded to the wktCacheEntries setting (LRU).
+# Native geometry values need no parsing and are not cached
+class wktCache:
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lastUsed = 0.0
+
+    def clear(self):
+        with _lock:
+            self.entries.clear()
+            self.size = 0
+
+    # drop the least recently used entries until size bytes are freed,
+    # returns the bytes freed
+    def shrink(self, size):
+        freed = 0
+        with _lock:
+            while freed < size and self.entries:
+                freed += self.entries.popitem(last=False)[1]["bytes"]
+            self.size -= freed
+        return freed
+
+    def result(self, value, name, compute):
+        if isinstance(value, QgsGeometry):
+            return compute(value)
+        key = bytes(value) if isinstance(value, (bytes, bytearray, QByteArray)) else value
+        maxEntries = _setting("wktCacheEntries", 256)
+        with _lock:
+            entry = self.entries.get(key)
+            self.lastUsed = time.monotonic()
+            missed = entry is None
+            if missed:
+                self.misses += 1
+                geom = _toGeometry(key)
+                entry = {"geometry": geom, "bytes": _geometryBytes(geom) + len(key)}
+                self.entries[key] = entry
+                self.size += entry["bytes"]
+                while len(self.entries) > maxEntries:
+                    self.size -= self.entries.popitem(last=False)[1]["bytes"]
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        if missed:
+            _memory.added()
+        if not name in entry:
+            entry[name] = compute(entry["geometry"])
+        return entry[name]
+
+_wktCache = wktCache()
+
+
 @qgsfunction(1, "Reference", register=False)
+@_instrumented
 def WKTcentroid(values, feature, parent):
     """
         Return the center of mass of the given geometry
@@ -475,25 +2317,24 @@ def WKTcentroid(values, feature, parent):
         <h4>Arguments</h4>
         <div class="arguments">
         <table>
-        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands </td></tr>
+        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands, a WKB geometry or a geometry value</td></tr>
         </table>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
         <div class="examples"><ul>
         <li><code>WKTcentroid('POLYGON((602793.98 6414014.88,....))')</code></li>
+        <li><code>WKTcentroid(geom_to_wkb($geometry))</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("centroid")
-    ArgGeometry = QgsGeometry().fromWkt(values[0])
     try:
-        return ArgGeometry.centroid().asWkt()
+        return _geometryResult(_wktCache.result(values[0], "centroid", lambda geom: geom.centroid()))
     except:
         parent.setEvalErrorString("error: WKT geometry not valid")
         return
 
 
 @qgsfunction(1, "Reference", register=False)
+@_instrumented
 def WKTpointonsurface(values, feature, parent):
     """
         Return the point within the given geometry
@@ -506,7 +2347,7 @@ def WKTpointonsurface(values, feature, parent):
         <h4>Arguments</h4>
         <div class="arguments">
         <table>
-        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands </td></tr>
+        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands, a WKB geometry or a geometry value</td></tr>
         </table>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -514,16 +2355,14 @@ def WKTpointonsurface(values, feature, parent):
         <li><code>WKTpointonsurface('POLYGON((602793.98 6414014.88,....))')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("centroid")
-    ArgGeometry = QgsGeometry().fromWkt(values[0])
     try:
-        return ArgGeometry.pointOnSurface().asWkt()
+        return _geometryResult(_wktCache.result(values[0], "pointonsurface", lambda geom: geom.pointOnSurface()))
     except:
         parent.setEvalErrorString("error: WKT geometry not valid")
         return
 
 @qgsfunction(1, "Reference", register=False)
+@_instrumented
 def WKTlength(values, feature, parent):
     """
         Return the length of the given geometry
@@ -536,7 +2375,7 @@ def WKTlength(values, feature, parent):
         <h4>Arguments</h4>
         <div class="arguments">
         <table>
-        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands </td></tr>
+        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands, a WKB geometry or a geometry value</td></tr>
         </table>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -544,16 +2383,14 @@ def WKTlength(values, feature, parent):
         <li><code>WKTlength('LINESTRING(602793.98 6414014.88,....)')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("length")
-    ArgGeometry = QgsGeometry().fromWkt(values[0])
     try:
-        return ArgGeometry.length()
+        return _wktCache.result(values[0], "length", lambda geom: geom.length())
     except:
         parent.setEvalErrorString("error: WKT geometry not valid")
         return
 
 @qgsfunction(1, "Reference", register=False)
+@_instrumented
 def WKTarea(values, feature, parent):
     """
         Return the area of the given geometry
@@ -566,7 +2403,7 @@ def WKTarea(values, feature, parent):
         <h4>Arguments</h4>
         <div class="arguments">
         <table>
-        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands </td></tr>
+        <tr><td class="argument">WKTgeometry</td><td>a valid WKT geometry provided by expression commands, a WKB geometry or a geometry value</td></tr>
         </table>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -574,18 +2411,16 @@ def WKTarea(values, feature, parent):
         <li><code>WKTarea('POLYGON((602793.98 6414014.88,....))')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("area")
-    ArgGeometry = QgsGeometry().fromWkt(values[0])
     try:
-        print(ArgGeometry.asWkt() )
-        return ArgGeometry.area()
+        return _wktCache.result(values[0], "area", lambda geom: geom.area())
     except:
         #parent.setEvalErrorString("error: WKT geometry not valid")
         return None
 
 @qgsfunction(2, "Reference", register=False, usesgeometry=True)
-def geomnearest(values, feature, parent):
+@_memoised
+@_instrumented
+def geomnearest(values, feature, parent, context):
     """
         Retrieve target_field value from the nearest feature in target_layer
         <h4>Syntax</h4>
@@ -603,7 +2438,7 @@ def geomnearest(values, feature, parent):
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.
         <br/>If target_field is equal to '$distance' the calculated distance between source and target features will be returned.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -614,54 +2449,34 @@ def geomnearest(values, feature, parent):
         <li><code>geomnearest('targetLayer','$distance')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomnearest")
     targetLayerName = values[0]
     targetFieldName = values[1]
-    dmin = sys.float_info.max
-    actualGeom = feature.geometry()
     layerSet = _getLayerSet()
     if not targetLayerName in layerSet.keys():
         parent.setEvalErrorString("error: targetLayer not present")
         return
-    count = 0
-    for name, layer in layerSet.items():
-        if layer != iface.mapCanvas().currentLayer() and layer.type() == QgsMapLayer.VectorLayer and (targetLayerName == '' or layer.name() == targetLayerName ):
-            dbg.out(layer.name())
-            iter = layer.getFeatures()
-            for feat in iter:
-                dtest = actualGeom.distance(feat.geometry())
-                count += 1
-                if count < 100000:
-                    if dtest<dmin:
-                        dmin = dtest
-                        if targetFieldName=="$geometry":
-                            dminRes = feat.geometry().asWkt()
-                        elif targetFieldName=="$distance":
-                            dminRes = dmin
-                        elif targetFieldName=="$id":
-                            dminRes = feat.id()
-                        else:
-                            try:
-                                dminRes = feat.attribute(targetFieldName)
-                            except:
-                                parent.setEvalErrorString("error: targetFieldName not present")
-                                return
-                else:
-                    parent.setEvalErrorString("error: too many features to compare")
-    dbg.out("DMIN")
-    dbg.out(dmin)
-    if count > 0:
-        try:
-            return dminRes
-        except:
-            return -1
-    else:
+    layer = layerSet[targetLayerName]
+    if layer == _currentLayer() or layer.type() != QgsMapLayer.VectorLayer:
+        parent.setEvalErrorString("error: no features to compare")
+        return
+    actualGeom = _sourceGeometry(feature, layer, context, parent)
+    if actualGeom is None:
+        return None
+    # the nearest feature may be outside of the visible extent
+    tIndex = _getTargetIndex(layer)
+    if not tIndex.ids:
         parent.setEvalErrorString("error: no features to compare")
+        return
+    fids = tIndex.nearestCandidates(layer, actualGeom)
+    if not fids:
+        return -1
+    return _nearestValue(layer, tIndex, fids, actualGeom, targetFieldName, None, workBudget(parent, context))
 
 
 @qgsfunction(3, "Reference", register=False, usesgeometry=True)
-def geomdistance(values, feature, parent):
+@_memoised
+@_instrumented
+def geomdistance(values, feature, parent, context):
     """
         Retrieve target_field value from feature in target_layer if target feature is in distance
         <h4>Syntax</h4>
@@ -680,7 +2495,7 @@ def geomdistance(values, feature, parent):
         <br/>If target_field is equal to '$distance' the calculated distance between source and target features will be returned.</td></tr>
         <tr><td class="argument">distance</td><td>the maximum distance from feature to be considered.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -691,56 +2506,80 @@ def geomdistance(values, feature, parent):
         <li><code>geomdistance('targetLayer','$distance',100)</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomdistance")
     targetLayerName = values[0]
     targetFieldName = values[1]
-    distanceCheck = values[2]
-    dmin = sys.float_info.max
-    actualGeom = feature.geometry()
+    try:
+        distanceCheck = float(values[2])
+    except (TypeError, ValueError):
+        parent.setEvalErrorString("error: invalid distance")
+        return
     layerSet = _getLayerSet()
     if not targetLayerName in layerSet.keys():
         parent.setEvalErrorString("error: targetLayer not present")
         return
-    count = 0
-    for name,layer in layerSet.items():
-        if layer != iface.mapCanvas().currentLayer() and layer.type() == QgsMapLayer.VectorLayer and (targetLayerName == '' or layer.name() == targetLayerName ):
-            dbg.out(layer.name())
-            iter = layer.getFeatures()
-            for feat in iter:
-                dtest = actualGeom.distance(feat.geometry())
-                count += 1
-                if count < 100000:
-                    if dtest<dmin and dtest<=distanceCheck:
-                        dmin = dtest
-                        if targetFieldName=="$geometry":
-                            dminRes = feat.geometry().asWkt()
-                        elif targetFieldName=="$distance":
-                            dminRes = dmin
-                        elif targetFieldName=="$id":
-                            dminRes = feat.id()
-                        else:
-                            try:
-                                dminRes = feat.attribute(targetFieldName)
-                            except:
-                                parent.setEvalErrorString("error: targetFieldName not present")
-                                return
-                else:
-                    parent.setEvalErrorString("error: too many features to compare")
-    dbg.out("DMIN")
-    dbg.out(dmin)
-    if count > 0:
-        try:
-            return dminRes
-        except:
-            return -1
-    else:
+    layer = layerSet[targetLayerName]
+    if layer == _currentLayer() or layer.type() != QgsMapLayer.VectorLayer:
         parent.setEvalErrorString("error: no features to compare")
-        
+        return
+    actualGeom = _sourceGeometry(feature, layer, context, parent)
+    if actualGeom is None:
+        return None
+    # the nearest feature may be outside of the visible extent
+    tIndex = _getTargetIndex(layer)
+    if not tIndex.ids:
+        parent.setEvalErrorString("error: no features to compare")
+        return
+    fids = sorted(tIndex.candidates(actualGeom.boundingBox().buffered(distanceCheck)))
+    if not fids:
+        return -1
+    return _nearestValue(layer, tIndex, fids, actualGeom, targetFieldName, distanceCheck, workBudget(parent, context))
+
+
+# Main function used by geomnearest and geomdistance
+# Target geometries are read through the decoded geometry cache
+def _nearestValue(layer, tIndex, fids, actualGeom, targetFieldName, distanceCheck, budget):
+    parent = budget.parent
+    if not fids:
+        parent.setEvalErrorString("error: no features to compare")
+        return
+    if not budget.consume(len(fids)):
+        return
+    dmin = sys.float_info.max
+    nearest = None
+    targetGeoms = tIndex.geometries(layer, fids)
+    for count, fid in enumerate(fids):
+        if not fid in targetGeoms:
+            continue
+        if count % 1000 == 999 and budget.exhausted():
+            return
+        dtest = actualGeom.distance(targetGeoms[fid])
+        if dtest<dmin and (distanceCheck is None or dtest<=distanceCheck):
+            dmin = dtest
+            nearest = fid
+    _log("DMIN")
+    _log(dmin)
+    if nearest is None:
+        return -1
+    _stats.addMatched(1)
+    if targetFieldName=="$geometry":
+        return _geometryResult(targetGeoms[nearest])
+    elif targetFieldName=="$distance":
+        return dmin
+    elif targetFieldName=="$id":
+        return nearest
+    reference = _getFieldReference(layer, targetFieldName)
+    if not reference.valid:
+        parent.setEvalErrorString("error: targetFieldName not present")
+        return
+    for feat in _featureSource(layer).getFeatures(reference.request(QgsFeatureRequest(nearest))):
+        return reference.value(feat)
+
 
 # Update Sigmoé
 # Main function used by all the geom... functions
-def geomsteval(values, feature, parent, predic, dbg):
+# Candidates are taken from the target layer spatial index, the disjoint
+# predicate is computed as the complement of the intersecting features
+def geomsteval(values, feature, parent, predic, context=None):
     targetLayerName = values[0]
     targetFieldName = values[1]
     #layerSet = {layer.name():layer for layer in iface.legendInterface().layers()}
@@ -748,57 +2587,109 @@ def geomsteval(values, feature, parent, predic, dbg):
     if not (targetLayerName in layerSet.keys()):
         parent.setEvalErrorString("error: targetLayer not present")
         return
-    dbg.out(layerSet)
-    dbg.out(layerSet[targetLayerName].id())
+    _log(layerSet)
+    _log(layerSet[targetLayerName].id())
     if layerSet[targetLayerName].type() != QgsMapLayer.VectorLayer:
         parent.setEvalErrorString("error: targetLayer is not a vector layer")
         return
-    count = 0
-    dminRes = ""
-    dminResLst = []
-    for feat in layerSet[targetLayerName].getFeatures():
-        count += 1
-        if count < 100000:
-            if eval("feature.geometry()." + predic + "(feat.geometry())"):
-                if targetFieldName=="$geometry":
-                    dminRes = feat.geometry().asWkt()
-                elif targetFieldName=="$id":
-                    dminRes = feat.id()
-                else:
-                    try:
-                        # Case of concatenation of several attribute values
-                        if "+" in targetFieldName:
-                            fld_names = targetFieldName.split("+")
-                            nw_val = ""
-                            for fld_name in fld_names:
-                                if feat.attribute(fld_name):
-                                    nw_val += str(feat.attribute(fld_name)) + " "
-                            nw_val = nw_val[:-1]
-                        else:
-                            nw_val = feat.attribute(targetFieldName)
-                        if nw_val not in dminResLst:
-                            if dminRes != "":
-                                dminRes = str(dminRes) + " | " + str(nw_val)
-                            else:
-                                dminRes = nw_val
-                            dminResLst.append(nw_val)
-                    except:
-                        parent.setEvalErrorString("error: targetFieldName not present")
-                        return None
-        else:
-            parent.setEvalErrorString("error: too many features to compare")
-    if count > 0:
+    targetLayer = layerSet[targetLayerName]
+    # features disjoint from the source may be outside of the visible extent
+    tIndex = _getTargetIndex(targetLayer, None if predic == "disjoint" else context)
+    if not tIndex.ids and not tIndex.partial:
+        parent.setEvalErrorString("error: no features to compare")
+        return None
+    mode = values[2] if len(values) > 2 else None
+    limit = None
+    if mode is not None and mode != "count":
         try:
-            return dminRes
-        except:
+            limit = int(mode)
+        except (TypeError, ValueError):
+            limit = -1
+        if limit < 0:
+            parent.setEvalErrorString("error: mode must be 'count' or a number of features")
             return None
-    else:
-        parent.setEvalErrorString("error: no features to compare")
+    sourceGeom = _sourceGeometry(feature, targetLayer, context, parent)
+    if sourceGeom is None:
         return None
+    # a feature without geometry verifies no predicate
+    if sourceGeom.isNull():
+        return 0 if mode == "count" else ""
+    budget = workBudget(parent, context)
+    fids = _matchingIds(targetLayer, tIndex, sourceGeom, "intersects" if predic == "disjoint" else predic, budget)
+    if fids is None:
+        return None
+    fids = set(fids)
+    if mode == "count":
+        return tIndex.locatedCount() - len(fids) if predic == "disjoint" else len(fids)
+    if predic == "disjoint":
+        fids = tIndex.disjointIds(fids)
+    if limit is not None:
+        fids = heapq.nsmallest(limit, fids)
+    fids = set(fids)
+    if not fids:
+        return ""
+    reference = _getFieldReference(targetLayer, targetFieldName)
+    request = reference.request(QgsFeatureRequest().setFilterFids(set(fids)))
+    return _collectValues(_featureSource(targetLayer).getFeatures(request), reference, parent)
+
+def _matchingIds(targetLayer, tIndex, geom, predic, budget=None):
+    candidates = tIndex.candidates(geom.boundingBox())
+    if budget and not budget.consume(len(candidates)):
+        return None
+    matched = []
+    # subdivided features intersect when any of their pieces does, within
+    # and contains are decided on the pieces when possible
+    if predic in ("intersects", "within", "contains") and tIndex.subdivided:
+        subdivided = {fid for fid in candidates if fid in tIndex.subdivided}
+        candidates = [fid for fid in candidates if not fid in tIndex.subdivided]
+        if predic == "intersects":
+            matched = list(tIndex.intersectingPieces(geom))
+        else:
+            found, undecided = tIndex.piecePredicate(geom, predic, subdivided)
+            matched = list(found)
+            candidates += sorted(undecided)
+    if not candidates:
+        return matched
+    targetGeoms = tIndex.geometries(targetLayer, candidates)
+    if tIndex.kept is None and predic != "equals" and _setting("prepareTargetGeometries", False) and _isMainThread():
+        sourceGeom = geom.constGet()
+        predic = _ENGINE_CONVERSE.get(predic, predic)
+        test = lambda fid, targetGeom: getattr(_geometryCache.engine(targetLayer, fid, targetGeom), predic)(sourceGeom)
+    else:
+        geomTest = getattr(geom, predic)
+        test = lambda fid, targetGeom: geomTest(targetGeom)
+    for count, (fid, targetGeom) in enumerate(targetGeoms.items()):
+        if budget and count % 1000 == 999 and budget.exhausted():
+            return None
+        if test(fid, targetGeom):
+            matched.append(fid)
+    _stats.addMatched(len(matched))
+    return matched
+
+def _collectValues(feats, reference, parent):
+    dminRes = ""
+    dminResLst = []
+    for feat in feats:
+        if not reference.valid:
+            parent.setEvalErrorString("error: targetFieldName not present")
+            return None
+        if reference.isGeometry or reference.isId:
+            dminRes = reference.value(feat)
+        else:
+            nw_val = reference.value(feat)
+            if nw_val not in dminResLst:
+                if dminRes != "":
+                    dminRes = str(dminRes) + " | " + str(nw_val)
+                else:
+                    dminRes = nw_val
+                dminResLst.append(nw_val)
+    return dminRes
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomwithin(values, feature, parent):
+@_memoised
+@_instrumented
+def geomwithin(values, feature, parent, context):
     """
         Retrieve target_field value when source feature is within feature in target_layer.
         If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
@@ -817,7 +2708,7 @@ def geomwithin(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -828,14 +2719,14 @@ def geomwithin(values, feature, parent):
         <li><code>geomwithin('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomwithin")
-    return geomsteval(values, feature, parent, "within", dbg)
+    return geomsteval(values, feature, parent, "within", context)
 
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomtouches(values, feature, parent):
+@_memoised
+@_instrumented
+def geomtouches(values, feature, parent, context):
     """
         Retrieve target_field value when source feature touches feature in target_layer.
         If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
@@ -854,7 +2745,7 @@ def geomtouches(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -865,14 +2756,14 @@ def geomtouches(values, feature, parent):
         <li><code>geomtouches('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomtouches")
-    return geomsteval(values, feature, parent, "touches", dbg)
+    return geomsteval(values, feature, parent, "touches", context)
         
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomintersects(values, feature, parent):
+@_memoised
+@_instrumented
+def geomintersects(values, feature, parent, context):
     """
         Retrieve target_field value when source feature intersects feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
@@ -890,7 +2781,7 @@ def geomintersects(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -901,14 +2792,14 @@ def geomintersects(values, feature, parent):
         <li><code>geomintersects('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomintersects")
-    return geomsteval(values, feature, parent, "intersects", dbg)
+    return geomsteval(values, feature, parent, "intersects", context)
 
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False, usesgeometry=True)
-def geomcontains(values, feature, parent):
+@_memoised
+@_instrumented
+def geomcontains(values, feature, parent, context):
     """
         Retrieve target_field value when source feature contains feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
@@ -926,7 +2817,7 @@ def geomcontains(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -937,20 +2828,20 @@ def geomcontains(values, feature, parent):
         <li><code>geomcontains('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomcontains")
-    return geomsteval(values, feature, parent, "contains", dbg)
+    return geomsteval(values, feature, parent, "contains", context)
     
 
 # Updated Sigmoé
-@qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomdisjoint(values, feature, parent):
+@qgsfunction(-1, "Reference", register=False,usesgeometry=True)
+@_memoised
+@_instrumented
+def geomdisjoint(values, feature, parent, context):
     """
         Retrieve target_field value when source feature is disjoint from target feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
         <div class="syntax"><code>
         <span class="functionname">geomdisjoint(</span>
-        <span class="argument">target_layer, target_field</span>
+        <span class="argument">target_layer, target_field[, mode]</span>
         <span class="functionname">)</span>
         </code></div>
         <h4>Arguments</h4>
@@ -961,8 +2852,9 @@ def geomdisjoint(values, feature, parent):
         <br/>If target_field contains the name of several fields separated by +, the result is the concatenation of the result value of each field.
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
+        <tr><td class="argument">mode</td><td>optional: 'count' returns the number of disjoint features, a number N retrieves only the first N disjoint features (by feature id).</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Disjoint features are found as all the target features minus the ones intersecting source feature</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -971,16 +2863,21 @@ def geomdisjoint(values, feature, parent):
         <li><code>geomdisjoint('Parcels','section+number')</code></li>
         <li><code>geomdisjoint('Buildings','$geometry')</code></li>
         <li><code>geomdisjoint('Buildings','$id')</code></li>
+        <li><code>geomdisjoint('Buildings','$id','count')</code></li>
+        <li><code>geomdisjoint('Buildings','Id',10)</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomdisjoint")
-    return geomsteval(values, feature, parent, "disjoint", dbg)
+    if len(values) not in (2, 3):
+        parent.setEvalErrorString("error: geomdisjoint expects 2 or 3 arguments")
+        return None
+    return geomsteval(values, feature, parent, "disjoint", context)
     
         
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomequals(values, feature, parent):
+@_memoised
+@_instrumented
+def geomequals(values, feature, parent, context):
     """
         Retrieve target_field value when source feature is equal (same geometry) to feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
@@ -998,7 +2895,7 @@ def geomequals(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -1009,14 +2906,14 @@ def geomequals(values, feature, parent):
         <li><code>geomequals('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomcontains")
-    return geomsteval(values, feature, parent, "equals", dbg)
+    return geomsteval(values, feature, parent, "equals", context)
 
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomoverlaps(values, feature, parent):
+@_memoised
+@_instrumented
+def geomoverlaps(values, feature, parent, context):
     """
         Retrieve target_field value when source feature overlaps feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
@@ -1034,7 +2931,7 @@ def geomoverlaps(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -1045,14 +2942,14 @@ def geomoverlaps(values, feature, parent):
         <li><code>geomoverlaps('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomcontains")
-    return geomsteval(values, feature, parent, "overlaps", dbg)
+    return geomsteval(values, feature, parent, "overlaps", context)
     
 
 # Updated Sigmoé
 @qgsfunction(2, "Reference", register=False,usesgeometry=True)
-def geomcrosses(values, feature, parent):
+@_memoised
+@_instrumented
+def geomcrosses(values, feature, parent, context):
     """
         Retrieve target_field value when source feature crosses feature in target_layer. If more than one object found, return a unique value composed of the value of each object separated by | (list of unique values).
         <h4>Syntax</h4>
@@ -1070,7 +2967,7 @@ def geomcrosses(values, feature, parent):
         <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
         <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
         </table>
-        <i>Number of feature tested is limited to 100000 to avoid time wasting loops</i>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
         </div>
         <h4>Examples</h4>
         <!-- Show examples of function.-->
@@ -1081,14 +2978,174 @@ def geomcrosses(values, feature, parent):
         <li><code>geomcrosses('targetLayer','$id')</code></li>
         </ul></div>
     """
-    dbg=debug()
-    dbg.out("evaluating geomcrosses")
-    return geomsteval(values, feature, parent, "crosses", dbg)      
+    return geomsteval(values, feature, parent, "crosses", context)      
         
 
+# DE-9IM patterns of the named predicates, the ones depending on the
+# dimensions of the geometries are resolved in _relatePredicate
+_RELATE_PATTERNS = {
+    "intersects": None,
+    "disjoint": ("FF*FF****",),
+    "within": ("T*F**F***",),
+    "contains": ("T*****FF*",),
+    "equals": ("T*F**FFF*",),
+    "touches": ("FT*******", "F**T*****", "F***T****"),
+    "crosses": None,
+    "overlaps": None,
+}
+
+def _relateMatches(matrix, pattern):
+    for m, p in zip(matrix, pattern):
+        if p == "*":
+            continue
+        if p == "T":
+            if m == "F":
+                return False
+        elif p != m:
+            return False
+    return True
+
+def _relatePredicate(matrix, predic, dimA, dimB):
+    if predic == "intersects":
+        return not _relateMatches(matrix, "FF*FF****")
+    if predic == "crosses":
+        if dimA < dimB:
+            return _relateMatches(matrix, "T*T******")
+        if dimA > dimB:
+            return _relateMatches(matrix, "T*****T**")
+        return dimA == 1 and _relateMatches(matrix, "0********")
+    if predic == "overlaps":
+        if dimA != dimB:
+            return False
+        if dimA == 1:
+            return _relateMatches(matrix, "1*T***T**")
+        return _relateMatches(matrix, "T*T***T**")
+    return any(_relateMatches(matrix, pattern) for pattern in _RELATE_PATTERNS[predic])
+
+def _isRelatePattern(arg):
+    return len(arg) == 9 and all(c in "TF*012" for c in arg.upper())
+
+@qgsfunction(3, "Reference", register=False, usesgeometry=True)
+@_memoised
+@_instrumented
+def geomrelate(values, feature, parent, context):
+    """
+        Retrieve target_field values of the features in target_layer related to source feature by a DE-9IM pattern or by several predicates at once.
+        The DE-9IM matrix is computed only once for each candidate target feature.
+        <h4>Syntax</h4>
+        <div class="syntax"><code>
+        <span class="functionname">geomrelate(</span>
+        <span class="argument">target_layer, target_field, pattern_or_predicates</span>
+        <span class="functionname">)</span>
+        </code></div>
+        <h4>Arguments</h4>
+        <div class="arguments">
+        <table>
+        <tr><td class="argument">target_layer</td><td>the name of a currently loaded layer, for example 'myLayer'.</td></tr>
+        <tr><td class="argument">target_field</td><td>a field in target_layer we want as result, for example 'myField'.
+        <br/>If target_field contains the name of several fields separated by +, the result is the concatenation of the result value of each field.
+        <br/>If target_field is equal to '$geometry' the WKT geometry of target feature will be retrieved.
+        <br/>If target_field is equal to '$id' the feature id of target feature will be retrieved.</td></tr>
+        <tr><td class="argument">pattern_or_predicates</td><td>a DE-9IM pattern as 'T*F**F***', returning the same result of the geom... functions,
+        <br/>or an array or a comma separated list of predicates among intersects, disjoint, within, contains, equals, touches, crosses, overlaps, returning a map with a result for each predicate.</td></tr>
+        </table>
+        <i>Number of features tested and evaluation time are limited by the maxFeatures and maxSeconds settings, evaluation stops when canceled</i>
+        </div>
+        <h4>Examples</h4>
+        <!-- Show examples of function.-->
+        <div class="examples"><ul>
+        <li><code>geomrelate('targetLayer','TargetField','T*F**F***')</code></li>
+        <li><code>geomrelate('targetLayer','$id','within,touches')</code></li>
+        <li><code>map_get(geomrelate('targetLayer','TargetField',array('intersects','touches')),'touches')</code></li>
+        </ul></div>
+    """
+    targetLayerName = values[0]
+    targetFieldName = values[1]
+    layerSet = _getLayerSet()
+    if not (targetLayerName in layerSet.keys()):
+        parent.setEvalErrorString("error: targetLayer not present")
+        return
+    if layerSet[targetLayerName].type() != QgsMapLayer.VectorLayer:
+        parent.setEvalErrorString("error: targetLayer is not a vector layer")
+        return
+    pattern = None
+    if isinstance(values[2], str) and _isRelatePattern(values[2]):
+        pattern = values[2].upper()
+        predicates = []
+    elif isinstance(values[2], str):
+        predicates = [predic.strip().lower() for predic in values[2].split(",")]
+    else:
+        predicates = [str(predic).strip().lower() for predic in values[2]]
+    for predic in predicates:
+        if not predic in _RELATE_PATTERNS:
+            parent.setEvalErrorString("error: unknown predicate %s" % predic)
+            return None
+
+    # disjoint and patterns not requiring any interior/boundary intersection
+    # may match features outside the source bounding box, and outside of
+    # the visible extent
+    distant = "disjoint" in predicates or pattern and not any(p in "T012" for p in pattern[0:2] + pattern[3:5])
+    targetLayer = layerSet[targetLayerName]
+    tIndex = _getTargetIndex(targetLayer, None if distant else context)
+    if not tIndex.ids and not tIndex.partial:
+        parent.setEvalErrorString("error: no features to compare")
+        return None
+    actualGeom = _sourceGeometry(feature, targetLayer, context, parent)
+    if actualGeom is None:
+        return None
+    if actualGeom.isNull():
+        parent.setEvalErrorString("error: source feature has no geometry")
+        return None
+    if pattern and distant:
+        candidates = list(tIndex.ids)
+    else:
+        candidates = tIndex.candidates(actualGeom.boundingBox())
+    budget = workBudget(parent, context)
+    if not budget.consume(len(candidates)):
+        return None
+
+    engine = QgsGeometry.createGeometryEngine(actualGeom.constGet())
+    engine.prepareGeometry()
+    dimA = actualGeom.type()
+    matched = {predic: set() for predic in predicates}
+    if pattern:
+        matched[pattern] = set()
+    intersecting = set()
+    for count, (fid, targetGeom) in enumerate(tIndex.geometries(targetLayer, candidates).items()):
+        if count % 1000 == 999 and budget.exhausted():
+            return None
+        matrix = engine.relate(targetGeom.constGet())
+        if pattern and _relateMatches(matrix, pattern):
+            matched[pattern].add(fid)
+        if _relatePredicate(matrix, "intersects", 0, 0):
+            intersecting.add(fid)
+        for predic in predicates:
+            if predic != "disjoint" and _relatePredicate(matrix, predic, dimA, targetGeom.type()):
+                matched[predic].add(fid)
+    if "disjoint" in matched:
+        matched["disjoint"] = set(tIndex.disjointIds(intersecting))
+
+    allIds = set().union(*matched.values())
+    _stats.addMatched(len(allIds))
+    reference = _getFieldReference(targetLayer, targetFieldName)
+    request = reference.request(QgsFeatureRequest().setFilterFids(allIds))
+    feats = {feat.id(): feat for feat in _featureSource(targetLayer).getFeatures(request)} if allIds else {}
+    results = {}
+    for key, fids in matched.items():
+        results[key] = _collectValues([feats[fid] for fid in sorted(fids) if fid in feats], reference, parent)
+        if results[key] is None:
+            return None
+    if pattern:
+        return results[pattern]
+    return results
+
+
+# Converse predicates, for the geom_count and geom_sum functions testing target against source feature
+_CONVERSE = {"within": "contains", "contains": "within"}
+
 # Updated Sigmoé
 # Main function used by ...geom_count functions
-def stgeomcounteval(values, feature, parent, predic):
+def stgeomcounteval(values, feature, parent, predic, context=None):
     DEBUG = False
     try:    #qgis 3
         if DEBUG : print('feat geom ',feature.geometry().asPolygon(), feature.geometry().area(), feature.hasGeometry())
@@ -1110,13 +3167,15 @@ def stgeomcounteval(values, feature, parent, predic):
             parent.setEvalErrorString("error: targetLayer is not a vector layer")
             return
             
-        count = 0
-        
-        request = qgis.core.QgsFeatureRequest()
-        request.setFilterRect(feature.geometry().boundingBox())
-        for feat in layerSet[targetLayerName].getFeatures(request):
-            if eval("feat.geometry()."+ predic + "(feature.geometry())"):
-                count += 1
+        targetLayer = layerSet[targetLayerName]
+        sourceGeom = _sourceGeometry(feature, targetLayer, context, parent)
+        if sourceGeom is None:
+            return None
+        # predic is evaluated from target to source feature
+        fids = _matchingIds(targetLayer, _getTargetIndex(targetLayer, context), sourceGeom, _CONVERSE.get(predic, predic), workBudget(parent, context))
+        if fids is None:
+            return None
+        count = len(fids)
         if DEBUG : print('feat ',feature.id(),'count',count)
         return count
         
@@ -1126,7 +3185,9 @@ def stgeomcounteval(values, feature, parent, predic):
         
 # Updated Sigmoé
 @qgsfunction(args=1, group="Reference",register = False, usesgeometry=True)
-def intersecting_geom_count(values, feature, parent):
+@_memoised
+@_instrumented
+def intersecting_geom_count(values, feature, parent, context):
     """
         Get the count of the features in target_layer that intersect the source feature
         <h4>Syntax</h4>
@@ -1147,11 +3208,13 @@ def intersecting_geom_count(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomcounteval(values, feature, parent, "intersects")
+    return stgeomcounteval(values, feature, parent, "intersects", context)
             
 
 @qgsfunction(args=1, group='Reference',register = False, usesgeometry=True)
-def within_geom_count(values, feature, parent):
+@_memoised
+@_instrumented
+def within_geom_count(values, feature, parent, context):
     """
         Get the count of the features in target_layer that are within the source feature
         <h4>Syntax</h4>
@@ -1172,10 +3235,12 @@ def within_geom_count(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomcounteval(values, feature, parent, "within")
+    return stgeomcounteval(values, feature, parent, "within", context)
         
 @qgsfunction(args=1, group='Reference',register = False, usesgeometry=True)
-def overlapping_geom_count(values, feature, parent):
+@_memoised
+@_instrumented
+def overlapping_geom_count(values, feature, parent, context):
     """
         Get the count of the features in target_layer overlaping the source feature
         <h4>Syntax</h4>
@@ -1196,12 +3261,14 @@ def overlapping_geom_count(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomcounteval(values, feature, parent, "overlaps")
+    return stgeomcounteval(values, feature, parent, "overlaps", context)
 
             
 
 @qgsfunction(args=1, group='Reference',register = False, usesgeometry=True)
-def equaling_geom_count(values, feature, parent):
+@_memoised
+@_instrumented
+def equaling_geom_count(values, feature, parent, context):
     """
         Get the count of the features in target_layer that are equals (same geometry) to the source feature
         <h4>Syntax</h4>
@@ -1222,12 +3289,12 @@ def equaling_geom_count(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomcounteval(values, feature, parent, "isGeosEqual")  
+    return stgeomcounteval(values, feature, parent, "isGeosEqual", context)  
             
             
 # Updated Sigmoé
 # Main function used by ...geom_sum functions
-def stgeomsumeval(values, feature, parent, predic):
+def stgeomsumeval(values, feature, parent, predic, context=None):
     DEBUG = False
     
     try:    #qgis 3
@@ -1251,15 +3318,28 @@ def stgeomsumeval(values, feature, parent, predic):
             
         count = 0.0
         
-        request = qgis.core.QgsFeatureRequest()
-        request.setFilterRect(feature.geometry().boundingBox())
-        for feat in layerSet[targetLayerName].getFeatures(request):
-            if eval("feat.geometry()." + predic + "(feature.geometry())"):
-                try:
-                    count += float(feat[targetFieldName])
-                except:
-                    #case feat[targetFieldName] is null or string....
-                    pass
+        targetLayer = layerSet[targetLayerName]
+        sourceGeom = _sourceGeometry(feature, targetLayer, context, parent)
+        if sourceGeom is None:
+            return None
+        # predic is evaluated from target to source feature
+        fids = _matchingIds(targetLayer, _getTargetIndex(targetLayer, context), sourceGeom, _CONVERSE.get(predic, predic), workBudget(parent, context))
+        if fids is None:
+            return None
+        reference = _getFieldReference(targetLayer, targetFieldName)
+        if reference.index < 0:
+            return count
+        snapshot = _getSnapshot(targetLayer)
+        total = snapshot.sum(targetLayer, reference.index, fids) if snapshot is not None else None
+        if total is not None:
+            return total
+        request = reference.request(QgsFeatureRequest().setFilterFids(set(fids)))
+        for feat in (_featureSource(targetLayer).getFeatures(request) if fids else []):
+            try:
+                count += float(feat.attributes()[reference.index])
+            except:
+                #case feat[targetFieldName] is null or string....
+                pass
         if DEBUG : print('feat ',feature.id(),'count',count)
         return count
         
@@ -1269,7 +3349,9 @@ def stgeomsumeval(values, feature, parent, predic):
 
 
 @qgsfunction(args=2, group="Reference",register = False, usesgeometry=True)
-def intersecting_geom_sum(values, feature, parent):
+@_memoised
+@_instrumented
+def intersecting_geom_sum(values, feature, parent, context):
     """
         Return the sum of the field_to_sum values of the objects in the target_layer that intersect the source feature
         <h4>Syntax</h4>
@@ -1291,12 +3373,14 @@ def intersecting_geom_sum(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomsumeval(values, feature, parent, "intersects")
+    return stgeomsumeval(values, feature, parent, "intersects", context)
         
         
 
 @qgsfunction(args=2, group='Reference',register = False, usesgeometry=True)
-def within_geom_sum(values, feature, parent):
+@_memoised
+@_instrumented
+def within_geom_sum(values, feature, parent, context):
     """
         Return the sum of the field_to_sum values of the objects in the target_layer that are within the source feature
         <h4>Syntax</h4>
@@ -1318,11 +3402,13 @@ def within_geom_sum(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomsumeval(values, feature, parent, "within")
+    return stgeomsumeval(values, feature, parent, "within", context)
         
 
 @qgsfunction(args=2, group='Reference',register = False, usesgeometry=True)
-def overlapping_geom_sum(values, feature, parent):
+@_memoised
+@_instrumented
+def overlapping_geom_sum(values, feature, parent, context):
     """
         Return the sum of the field_to_sum values of the objects in the target_layer overlapping the source feature
         <h4>Syntax</h4>
@@ -1344,25 +3430,26 @@ def overlapping_geom_sum(values, feature, parent):
         </ul></div>
     """ 
     
-    return stgeomsumeval(values, feature, parent, "overlaps")
+    return stgeomsumeval(values, feature, parent, "overlaps", context)
 
         
         
         
         
-class debug:
-
-    def __init__(self):
-        self.debug = None
-
-    def out(self,string):
-        if self.debug:
-            print(string)
+# Functions registered by the plugin
+REFERENCE_FUNCTIONS = [
+    dbvalue, dbvaluebyid, dbquery, dbsql,
+    WKTarea, WKTcentroid, WKTpointonsurface, WKTlength,
+    geomRedef, geomnearest, geomdistance,
+    geomwithin, geomcontains, geomcrosses, geomdisjoint, geomequals, geomintersects, geomoverlaps, geomtouches, geomrelate,
+    canvaswidth, canvasheight, canvasx, canvasy,
+    intersecting_geom_count, within_geom_count, overlapping_geom_count, equaling_geom_count,
+    intersecting_geom_sum, within_geom_sum, overlapping_geom_sum,
+]
 
 class SQLconnection:
 
     def __init__(self,conn):
-        self.dbg = debug()
         s = QSettings()
         s.beginGroup("PostgreSQL/connections/"+conn)
         currentKeys = s.childKeys()
@@ -1389,11 +3476,11 @@ class SQLconnection:
     def submitQuery(self,sql):
         query = QSqlQuery(self.db)
         query.exec_(sql)
-        self.dbg.out(sql)
+        _log(sql)
         rows= []
-        self.dbg.out("SQL RESULT:")
-        self.dbg.out(query.lastError().type())
-        self.dbg.out(query.lastError().text())
+        _log("SQL RESULT:")
+        _log(query.lastError().type())
+        _log(query.lastError().text())
         if query.lastError().type() != QSqlError.NoError:
             self.error = "Database Error: %s" % query.lastError().text()
             #QMessageBox.information(None, "SQL ERROR:", resultQuery)
@@ -1411,7 +3498,7 @@ class SQLconnection:
                     except AttributeError:
                         fields.append(str(query.value(k)))
                 rows += [fields]
-        self.dbg.out(rows)
+        _log(rows)
         return rows
 
     def lastError(self):
@@ -1424,48 +3511,35 @@ class refFunctions:
         self.iface = iface
         # initialize plugin directory
         self.plugin_dir = os.path.dirname(__file__)
-        self.dbg = debug()
         self.dlg = refFunctionsDialog()
+        _stats.enabled = _setting("instrumentation", False)
+        self.dlg.statisticsCheckBox.setChecked(_stats.enabled)
+        self.dlg.statisticsCheckBox.toggled.connect(self.setStatisticsEnabled)
+        self.dlg.refreshStatisticsButton.clicked.connect(self.showStatistics)
+        self.dlg.resetStatisticsButton.clicked.connect(self.resetStatistics)
+        self.dlg.exportStatisticsButton.clicked.connect(self.exportStatistics)
+        _profile.finished = self.showProfile
+        self.dlg.profileButton.toggled.connect(self.setProfileArmed)
+        self.dlg.saveProfileButton.clicked.connect(self.saveProfile)
+        self.dlg.warmupButton.clicked.connect(self.warmup)
 
         # Create the dialog (after translation) and keep reference
         #self.dlg = refFunctionDialog()
 
 
     def initGui(self):
-        self.dbg.out("initGui")
-        QgsExpression.registerFunction(dbvalue)
-        QgsExpression.registerFunction(dbvaluebyid)
-        QgsExpression.registerFunction(dbquery)
-        QgsExpression.registerFunction(dbsql)
-        QgsExpression.registerFunction(WKTarea)
-        QgsExpression.registerFunction(WKTcentroid)
-        QgsExpression.registerFunction(WKTpointonsurface)
-        QgsExpression.registerFunction(WKTlength)
-        QgsExpression.registerFunction(geomRedef)
-        QgsExpression.registerFunction(geomnearest)
-        QgsExpression.registerFunction(geomdistance)
-        QgsExpression.registerFunction(geomwithin)
-        QgsExpression.registerFunction(geomcontains)
-        QgsExpression.registerFunction(geomcrosses)
-        QgsExpression.registerFunction(geomdisjoint)
-        QgsExpression.registerFunction(geomequals)
-        QgsExpression.registerFunction(geomintersects)
-        QgsExpression.registerFunction(geomoverlaps)
-        QgsExpression.registerFunction(geomtouches)
-        QgsExpression.registerFunction(canvaswidth)
-        QgsExpression.registerFunction(canvasheight)
-        QgsExpression.registerFunction(canvasx)
-        QgsExpression.registerFunction(canvasy)
-        
-        QgsExpression.registerFunction(intersecting_geom_count)
-        QgsExpression.registerFunction(within_geom_count)
-        QgsExpression.registerFunction(overlapping_geom_count)
-        QgsExpression.registerFunction(intersecting_geom_sum)
-        QgsExpression.registerFunction(within_geom_sum)
-        QgsExpression.registerFunction(overlapping_geom_sum)
-        
-        QgsExpression.registerFunction(equaling_geom_count)
+        _log("initGui")
+        for function in REFERENCE_FUNCTIONS:
+            QgsExpression.registerFunction(function)
         
+        self.iface.mapCanvas().extentsChanged.connect(_refreshCanvasSnapshot)
+        self.iface.mapCanvas().renderStarting.connect(_prepareFeatureSources)
+        _refreshCanvasSnapshot()
+
+        from .reffunctionsprovider import refFunctionsProvider
+        self.provider = refFunctionsProvider()
+        qgis.core.QgsApplication.processingRegistry().addProvider(self.provider)
+
         icon_path = os.path.join(self.plugin_dir,"icon.png")
         # map tool action
         self.action = QAction(QIcon(icon_path),"refFunctions", self.iface.mainWindow())
@@ -1475,41 +3549,88 @@ class refFunctions:
 
 
     def unload(self):
-        QgsExpression.unregisterFunction('dbvalue')
-        QgsExpression.unregisterFunction('dbvaluebyid')
-        QgsExpression.unregisterFunction('dbquery')
-        QgsExpression.unregisterFunction('dbsql')
-        QgsExpression.unregisterFunction('WKTarea')
-        QgsExpression.unregisterFunction('WKTcentroid')
-        QgsExpression.unregisterFunction('WKTpointonsurface')
-        QgsExpression.unregisterFunction('WKTlength')
-        QgsExpression.unregisterFunction('geomRedef')
-        QgsExpression.unregisterFunction('geomnearest')
-        QgsExpression.unregisterFunction('geomdistance')
-        QgsExpression.unregisterFunction('geomwithin')
-        QgsExpression.unregisterFunction('geomcontains')
-        QgsExpression.unregisterFunction('geomcrosses')
-        QgsExpression.unregisterFunction('geomdisjoint')
-        QgsExpression.unregisterFunction('geomequals')
-        QgsExpression.unregisterFunction('geomintersects')
-        QgsExpression.unregisterFunction('geomoverlaps')
-        QgsExpression.unregisterFunction('geomtouches')
-        QgsExpression.unregisterFunction('canvaswidth')
-        QgsExpression.unregisterFunction('canvasheight')
-        QgsExpression.unregisterFunction('canvasx')
-        QgsExpression.unregisterFunction('canvasy')
-        
-        QgsExpression.unregisterFunction('intersecting_geom_count')
-        QgsExpression.unregisterFunction('within_geom_count')
-        QgsExpression.unregisterFunction('overlapping_geom_count')
-        QgsExpression.unregisterFunction('intersecting_geom_sum')
-        QgsExpression.unregisterFunction('within_geom_sum')
-        QgsExpression.unregisterFunction('overlapping_geom_sum')
-        
-        QgsExpression.unregisterFunction('equaling_geom_count')
+        for function in REFERENCE_FUNCTIONS:
+            QgsExpression.unregisterFunction(function.name())
+
+        for task in list(_warmupTasks):
+            task.cancel()
+        _targetIndexes.clear()
+        _extentTiles.clear()
+        _geometryCache.clear()
+        _wktCache.clear()
+        _fieldReferences.clear()
+        _resultMemo.clear()
+        _transforms.clear()
+        _keyIndexes.clear()
+        _queryColumns.clear()
+        _snapshots.clear()
+        _layerRevisions.clear()
+        _deferredEdits.clear()
+        _pendingGeometries.clear()
+        _unwatchLayers()
+        _resetLayerSet()
+        _watchProject(False)
         
+        self.iface.mapCanvas().extentsChanged.disconnect(_refreshCanvasSnapshot)
+        self.iface.mapCanvas().renderStarting.disconnect(_prepareFeatureSources)
+        _featureSources.clear()
+        _layerStates.clear()
+        _sourcePools.clear()
+        qgis.core.QgsApplication.processingRegistry().removeProvider(self.provider)
+
         self.iface.removePluginMenu(u"&refFunctions", self.action)
         self.iface.removeToolBarIcon(self.action)
 
     def run(self):
+        self.showStatistics()
         self.dlg.show()
+
+    def showStatistics(self):
+        self.dlg.showStatistics(_stats.report())
+
+    def warmup(self):
+        layer = self.dlg.warmupLayerComboBox.currentLayer()
+        if layer is None:
+            return
+        task = warmIndexes(layer, self.dlg.warmupFields(), self.dlg.warmupSpatialCheckBox.isChecked())
+        name = layer.name()
+        self.dlg.warmupLabel.setText("building the indexes of %s..." % name)
+        done = lambda: self.dlg.warmupLabel.setText("indexes of %s ready" % name if task.error is None and task.status() == task.Complete
+                                                    else "indexes of %s not built: %s" % (name, task.error or "canceled"))
+        task.taskCompleted.connect(done)
+        task.taskTerminated.connect(done)
+
+    def setStatisticsEnabled(self, enabled):
+        _stats.enabled = bool(enabled)
+        QSettings().setValue("refFunctions/instrumentation", _stats.enabled)
+
+    def resetStatistics(self):
+        _stats.reset()
+        _geometryCache.hits = _geometryCache.misses = 0
+        _wktCache.hits = _wktCache.misses = 0
+        _memory.evictions = 0
+        self.showStatistics()
+
+    def setProfileArmed(self, armed):
+        if armed:
+            _profile.arm()
+            self.dlg.showProfile("Waiting for the next evaluation using refFunctions...")
+        else:
+            _profile.armed = False
+
+    def showProfile(self, report):
+        self.dlg.profileButton.setChecked(False)
+        self.dlg.saveProfileButton.setEnabled(True)
+        self.dlg.showProfile(report)
+        self.dlg.tabWidget.setCurrentWidget(self.dlg.profileTab)
+        self.dlg.show()
+
+    def saveProfile(self):
+        path, _filter = QFileDialog.getSaveFileName(self.dlg, "Save profile", "", "pstats (*.pstats *.prof)")
+        if path:
+            _profile.save(path)
+
+    def exportStatistics(self):
+        path, _filter = QFileDialog.getSaveFileName(self.dlg, "Export statistics", "", "JSON (*.json)")
+        if path:
+            _stats.export(path)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ReferenceFunctions batch runner
+                                 A QGIS plugin
+ Provide field calculator function for Reference to other layers/features
+                              -------------------
+ Headless evaluation of a refFunctions expression across a layer of a
+ GeoPackage or of a QGIS project, writing the results back in chunks with
+ bulk changeAttributeValues. From the QGIS plugins directory:
+
+   python -m refFunctions.reffunctionsbatch data.gpkg parcels zone "geomwithin('zones','name')"
+   python -m refFunctions.reffunctionsbatch project.qgz parcels zone "geomwithin('zones','name')" --processes 4
+
+ or from Python:
+
+   from refFunctions.reffunctionsbatch import runBatch
+   runBatch("data.gpkg", "parcels", "zone", "geomwithin('zones','name')")
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import sys
+import argparse
+import multiprocessing
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsApplication, QgsProject, QgsVectorLayer, QgsDataProvider, QgsField, QgsGeometry,
+                       QgsExpression, QgsExpressionContext, QgsExpressionContextUtils, QgsFeatureRequest)
+
+FIELD_TYPES = {"string": QVariant.String, "integer": QVariant.LongLong, "double": QVariant.Double}
+
+
+def openSource(source):
+    """Load a project, or every layer of a GeoPackage, in the current project"""
+    project = QgsProject.instance()
+    if os.path.splitext(source)[1].lower() in (".qgs", ".qgz"):
+        if not project.read(source):
+            raise IOError("unable to read project %s" % source)
+        return
+    probe = QgsVectorLayer(source, "probe", "ogr")
+    if not probe.isValid():
+        raise IOError("unable to open %s" % source)
+    for subLayer in probe.dataProvider().subLayers():
+        name = subLayer.split(QgsDataProvider.SUBLAYER_SEPARATOR)[1]
+        layer = QgsVectorLayer("%s|layername=%s" % (source, name), name, "ogr")
+        if layer.isValid():
+            project.addMapLayer(layer)
+
+
+def _getLayer(layerName):
+    layers = QgsProject.instance().mapLayersByName(layerName)
+    if not layers:
+        raise ValueError("layer %s not found" % layerName)
+    return layers[0]
+
+
+def _plain(value):
+    # results are sent between processes and written to the provider
+    if value is None or (isinstance(value, QVariant) and value.isNull()):
+        return None
+    if isinstance(value, (bool, int, float, str, bytes)):
+        return value
+    if isinstance(value, QgsGeometry):
+        return value.asWkt()
+    return str(value)
+
+
+def evaluateChunk(layerName, expression, fids):
+    """Evaluate expression on the fids features of layerName, returns ({fid: value}, errors)"""
+    layer = _getLayer(layerName)
+    exp = QgsExpression(expression)
+    context = QgsExpressionContext()
+    context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+    exp.prepare(context)
+    values = {}
+    errors = []
+    for feat in layer.getFeatures(QgsFeatureRequest().setFilterFids(set(fids))):
+        context.setFeature(feat)
+        value = exp.evaluate(context)
+        if exp.hasEvalError():
+            errors.append((feat.id(), exp.evalErrorString()))
+            continue
+        values[feat.id()] = _plain(value)
+    return values, errors
+
+
+def _registerFunctions():
+    from .reffunctions import REFERENCE_FUNCTIONS
+    for function in REFERENCE_FUNCTIONS:
+        QgsExpression.registerFunction(function)
+
+
+# process pool workers own a QGIS application and a copy of the source
+_workerApp = None
+
+def _initWorker(source):
+    global _workerApp
+    _workerApp = QgsApplication([], False)
+    _workerApp.initQgis()
+    openSource(source)
+    _registerFunctions()
+
+def _evaluateChunkInWorker(args):
+    return evaluateChunk(*args)
+
+
+def runBatch(source, layerName, fieldName, expression, chunkSize=10000, processes=1, fieldType=None, progress=None):
+    """
+    Evaluate expression on every feature of layerName and write the results to fieldName.
+    The source (GeoPackage or project) is opened in the current project, a QgsApplication must be running.
+    Chunks are evaluated by a pool of processes when processes > 1, results are always written
+    by the calling process. Returns the number of features updated and the list of (fid, error).
+    """
+    openSource(source)
+    _registerFunctions()
+    layer = _getLayer(layerName)
+    provider = layer.dataProvider()
+    fieldIndex = layer.fields().indexOf(fieldName)
+    if fieldIndex < 0:
+        if fieldType is None:
+            raise ValueError("field %s not found in %s" % (fieldName, layerName))
+        provider.addAttributes([QgsField(fieldName, FIELD_TYPES[fieldType])])
+        layer.updateFields()
+        fieldIndex = layer.fields().indexOf(fieldName)
+
+    fids = sorted(feat.id() for feat in layer.getFeatures(QgsFeatureRequest().setNoAttributes().setFlags(QgsFeatureRequest.NoGeometry)))
+    chunks = [(layerName, expression, fids[i:i + chunkSize]) for i in range(0, len(fids), chunkSize)]
+    if processes > 1:
+        pool = multiprocessing.get_context("spawn").Pool(processes, _initWorker, (source,))
+        results = pool.imap(_evaluateChunkInWorker, chunks)
+    else:
+        pool = None
+        results = (evaluateChunk(*chunk) for chunk in chunks)
+
+    updated = 0
+    errors = []
+    try:
+        for done, (values, chunkErrors) in enumerate(results, 1):
+            provider.changeAttributeValues({fid: {fieldIndex: value} for fid, value in values.items()})
+            updated += len(values)
+            errors += chunkErrors
+            if progress:
+                progress(done, len(chunks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return updated, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="evaluate a refFunctions expression across a layer")
+    parser.add_argument("source", help="GeoPackage or QGIS project")
+    parser.add_argument("layer", help="name of the layer to update")
+    parser.add_argument("field", help="name of the field receiving the results")
+    parser.add_argument("expression", help="QGIS expression using refFunctions")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=1, help="number of worker processes evaluating the chunks")
+    parser.add_argument("--create-field", choices=sorted(FIELD_TYPES), help="create the field with this type when missing")
+    args = parser.parse_args(argv)
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    progress = lambda done, total: print("chunk %d/%d" % (done, total), file=sys.stderr)
+    try:
+        updated, errors = runBatch(args.source, args.layer, args.field, args.expression,
+                                   args.chunk_size, args.processes, args.create_field, progress)
+    finally:
+        QgsProject.instance().clear()
+    for fid, error in errors[:20]:
+        print("feature %d: %s" % (fid, error), file=sys.stderr)
+    print("%d features updated, %d errors" % (updated, len(errors)))
+    app.exitQgis()
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ReferenceFunctions benchmark
+                                 A QGIS plugin
+ Provide field calculator function for Reference to other layers/features
+                              -------------------
+ Offline benchmark of the reference functions over synthetic memory layers,
+ running headless with an offscreen QGIS application.
+ From the QGIS plugins directory:
+
+   python -m refFunctions.reffunctionsbenchmark --sizes 1000,10000 --output results.json
+   python -m refFunctions.reffunctionsbenchmark --sizes 1000,10000 --compare results.json
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from qgis.PyQt.QtCore import QSettings
+from qgis.core import (QgsApplication, QgsProject, QgsVectorLayer, QgsFeature, QgsGeometry, QgsPointXY, QgsRectangle,
+                       QgsExpression, QgsExpressionContext, QgsExpressionContextUtils, Qgis)
+
+# synthetic layers cover a square of EXTENT map units
+EXTENT = 100000.0
+
+# plugin settings of every run, read from a scratch settings file so that
+# the user settings do not leak into the results. No work budget, so that
+# the largest sizes time actual work
+SETTINGS = {
+    "subdivideVertices": 0,
+    "geometryCacheMB": 64,
+    "prepareTargetGeometries": False,
+    "maxFeatures": 0,
+    "maxSeconds": 0.0,
+    "maxRunFeatures": 0,
+    "maxRunSeconds": 0.0,
+    "wktCacheEntries": 256,
+    "returnGeometries": False,
+    "indexCache": False,
+    "columnarSnapshots": False,
+    "visibleExtentOnly": False,
+    "memoiseResults": False,
+    "memoryBudgetMB": 0,
+    "instrumentation": False,
+}
+
+# benchmarked expressions, {target} is replaced by the target layer name
+EXPRESSIONS = [
+    ("dbvalue", "points", "dbvalue('{target}','name','key',key)"),
+    ("dbquery", "points", "dbquery('{target}','name','key = 1')"),
+    ("dbvaluebyid", "points", "dbvaluebyid('{target}','name',$id)"),
+    ("geomnearest", "points", "geomnearest('{target}','name')"),
+    ("geomdistance", "points", "geomdistance('{target}','name',1000)"),
+    ("geomwithin", "polygons", "geomwithin('{target}','name')"),
+    ("geomtouches", "polygons", "geomtouches('{target}','name')"),
+    ("geomintersects", "polygons", "geomintersects('{target}','name')"),
+    ("geomcontains", "points", "geomcontains('{target}','name')"),
+    ("geomdisjoint", "polygons", "geomdisjoint('{target}','$id','count')"),
+    ("geomequals", "polygons", "geomequals('{target}','name')"),
+    ("geomoverlaps", "polygons", "geomoverlaps('{target}','name')"),
+    ("geomcrosses", "lines", "geomcrosses('{target}','name')"),
+    ("geomrelate", "polygons", "geomrelate('{target}','name','intersects,touches,within')"),
+    ("intersecting_geom_count", "points", "intersecting_geom_count('{target}')"),
+    ("within_geom_count", "points", "within_geom_count('{target}')"),
+    ("overlapping_geom_count", "polygons", "overlapping_geom_count('{target}')"),
+    ("equaling_geom_count", "polygons", "equaling_geom_count('{target}')"),
+    ("intersecting_geom_sum", "points", "intersecting_geom_sum('{target}','value')"),
+    ("within_geom_sum", "points", "within_geom_sum('{target}','value')"),
+    ("overlapping_geom_sum", "polygons", "overlapping_geom_sum('{target}','value')"),
+    ("WKTcentroid", None, "WKTcentroid(geom_to_wkt($geometry))"),
+    ("WKTpointonsurface", None, "WKTpointonsurface(geom_to_wkt($geometry))"),
+    ("WKTlength", None, "WKTlength(geom_to_wkt($geometry))"),
+    ("WKTarea", None, "WKTarea(geom_to_wkt($geometry))"),
+]
+
+
+def _randomGeometry(kind, rnd, size):
+    x = rnd.uniform(0, EXTENT)
+    y = rnd.uniform(0, EXTENT)
+    if kind == "points":
+        return QgsGeometry.fromPointXY(QgsPointXY(x, y))
+    if kind == "lines":
+        return QgsGeometry.fromPolylineXY([QgsPointXY(x, y), QgsPointXY(x + rnd.uniform(-size, size), y + rnd.uniform(-size, size))])
+    return QgsGeometry.fromRect(QgsRectangle(x, y, x + size, y + size))
+
+
+def createLayer(kind, count, cardinality, seed):
+    geometryType = {"points": "Point", "lines": "LineString", "polygons": "Polygon"}[kind]
+    name = "%s_%d" % (kind, count)
+    layer = QgsVectorLayer("%s?crs=EPSG:3857&field=key:integer&field=value:double&field=name:string(20)" % geometryType, name, "memory")
+    rnd = random.Random(seed)
+    # keep the mean feature size proportional to the average spacing
+    size = EXTENT / max(count, 1) ** 0.5
+    features = []
+    for i in range(count):
+        feat = QgsFeature(layer.fields())
+        key = rnd.randrange(cardinality)
+        feat.setAttributes([key, rnd.uniform(0, 100), "name_%d" % key])
+        feat.setGeometry(_randomGeometry(kind, rnd, size))
+        features.append(feat)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    QgsProject.instance().addMapLayer(layer)
+    return layer
+
+
+def timeExpression(expression, sourceLayer, maxSeconds):
+    exp = QgsExpression(expression)
+    context = QgsExpressionContext()
+    context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(sourceLayer))
+    exp.prepare(context)
+    evaluated = 0
+    errors = 0
+    firstError = None
+    start = time.perf_counter()
+    for feat in sourceLayer.getFeatures():
+        context.setFeature(feat)
+        exp.evaluate(context)
+        if exp.hasEvalError():
+            errors += 1
+            firstError = firstError or exp.evalErrorString()
+        evaluated += 1
+        if maxSeconds and time.perf_counter() - start > maxSeconds:
+            break
+    elapsed = time.perf_counter() - start
+    return evaluated, errors, firstError, elapsed
+
+
+def runBenchmark(sizes, sources, cardinality, seed, maxSeconds, functions=None):
+    from .reffunctions import REFERENCE_FUNCTIONS
+    for function in REFERENCE_FUNCTIONS:
+        QgsExpression.registerFunction(function)
+
+    sourceLayer = createLayer("polygons", sources, cardinality, seed)
+    results = []
+    for size in sizes:
+        targets = {kind: createLayer(kind, size, cardinality, seed + size) for kind in ("points", "lines", "polygons")}
+        for name, kind, expression in EXPRESSIONS:
+            if functions and not name in functions:
+                continue
+            if kind is None and size != sizes[0]:
+                continue
+            expression = expression.format(target=targets[kind].name() if kind else "")
+            evaluated, errors, firstError, elapsed = timeExpression(expression, sourceLayer, maxSeconds)
+            # error returns are not timings of the function
+            if errors:
+                raise RuntimeError("%s: %d evaluation errors, first one: %s" % (expression, errors, firstError))
+            results.append({
+                "function": name,
+                "expression": expression,
+                "target_features": size if kind else 0,
+                "source_features": evaluated,
+                "errors": errors,
+                "seconds": elapsed,
+                "ms_per_feature": elapsed * 1000 / evaluated if evaluated else None,
+            })
+            print("%-24s %8s targets %10.3f ms/feature" % (name, size if kind else "-", results[-1]["ms_per_feature"] or 0), file=sys.stderr)
+        for layer in targets.values():
+            QgsProject.instance().removeMapLayer(layer.id())
+
+    for function in REFERENCE_FUNCTIONS:
+        QgsExpression.unregisterFunction(function.name())
+    return results
+
+
+# plugin settings read from an ini file in directory, holding SETTINGS only
+def useScratchSettings(directory):
+    QSettings.setDefaultFormat(QSettings.IniFormat)
+    QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, directory)
+    settings = QSettings()
+    settings.remove("refFunctions")
+    for key, value in SETTINGS.items():
+        settings.setValue("refFunctions/" + key, value)
+    settings.sync()
+
+
+def _pluginVersion():
+    metadata = os.path.join(os.path.dirname(__file__), "metadata.txt")
+    with open(metadata) as f:
+        for line in f:
+            if line.startswith("version="):
+                return line.split("=", 1)[1].strip()
+
+
+# comparison table on stderr, stdout may hold the JSON report
+def compare(results, previous):
+    before = {(r["function"], r["target_features"]): r for r in previous["results"]}
+    for r in results:
+        old = before.get((r["function"], r["target_features"]))
+        if old and old["ms_per_feature"] and r["ms_per_feature"]:
+            print("%-24s %8s targets %10.3f -> %10.3f ms/feature (x%.2f)" % (
+                r["function"], r["target_features"], old["ms_per_feature"], r["ms_per_feature"], old["ms_per_feature"] / r["ms_per_feature"]),
+                file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="refFunctions benchmark over synthetic memory layers")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated target layer sizes, up to 1000000")
+    parser.add_argument("--sources", type=int, default=200, help="number of source features evaluated")
+    parser.add_argument("--cardinality", type=int, default=100, help="number of distinct key values")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-seconds", type=float, default=60, help="time limit for each expression, 0 for none")
+    parser.add_argument("--functions", help="comma separated functions to benchmark, all by default")
+    parser.add_argument("--output", help="JSON results file, stdout by default")
+    parser.add_argument("--compare", help="previous JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    scratch = tempfile.TemporaryDirectory()
+    useScratchSettings(scratch.name)
+    try:
+        results = runBenchmark([int(size) for size in args.sizes.split(",")], args.sources, args.cardinality, args.seed,
+                               args.max_seconds, args.functions.split(",") if args.functions else None)
+    finally:
+        QgsProject.instance().clear()
+        scratch.cleanup()
+    report = {
+        "plugin_version": _pluginVersion(),
+        "qgis_version": Qgis.QGIS_VERSION,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "settings": SETTINGS,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    app.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,9 +26,15 @@ try:
     from qgis.PyQt.QtGui import QDialog
 except:
     from qgis.PyQt.QtWidgets import QDialog
+from qgis.PyQt.QtWidgets import QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QCheckBox, QPushButton, QTableWidget, QTableWidgetItem, QLabel, QTextEdit, QListWidget, QListWidgetItem
+from qgis.PyQt.QtCore import Qt
+from qgis.core import QgsMapLayerProxyModel
+from qgis.gui import QgsMapLayerComboBox
     
 from .ui_reffunctions import Ui_refFunctionDialog
 
+STATISTICS_COLUMNS = ["calls", "total_ms", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "scanned", "matched"]
+
 class refFunctionsDialog(QDialog, Ui_refFunctionDialog):
     def __init__(self):
         QDialog.__init__(self)
@@ -38,3 +44,101 @@ class refFunctionsDialog(QDialog, Ui_refFunctionDialog):
         # http://qt-project.org/doc/qt-4.8/designer-using-a-ui-file.html
         # #widgets-and-dialogs-with-auto-connect
         self.setupUi(self)
+        # help text in the first tab, tools of the plugin in the other ones
+        self.horizontalLayout.removeWidget(self.textEdit)
+        self.tabWidget = QTabWidget(self)
+        self.tabWidget.addTab(self.textEdit, "Help")
+        self.horizontalLayout.addWidget(self.tabWidget)
+        self.setupStatisticsTab()
+        self.setupProfileTab()
+        self.setupWarmupTab()
+
+    def setupStatisticsTab(self):
+        tab = QWidget()
+        layout = QVBoxLayout(tab)
+        self.statisticsCheckBox = QCheckBox("Record calls statistics", tab)
+        layout.addWidget(self.statisticsCheckBox)
+        self.statisticsTable = QTableWidget(0, len(STATISTICS_COLUMNS), tab)
+        self.statisticsTable.setHorizontalHeaderLabels(STATISTICS_COLUMNS)
+        layout.addWidget(self.statisticsTable)
+        self.cachesLabel = QLabel(tab)
+        layout.addWidget(self.cachesLabel)
+        self.memoryLabel = QLabel(tab)
+        layout.addWidget(self.memoryLabel)
+        buttons = QHBoxLayout()
+        self.refreshStatisticsButton = QPushButton("Refresh", tab)
+        self.resetStatisticsButton = QPushButton("Reset", tab)
+        self.exportStatisticsButton = QPushButton("Export JSON...", tab)
+        for button in (self.refreshStatisticsButton, self.resetStatisticsButton, self.exportStatisticsButton):
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+        self.tabWidget.addTab(tab, "Statistics")
+
+    def setupProfileTab(self):
+        self.profileTab = QWidget()
+        layout = QVBoxLayout(self.profileTab)
+        self.profileButton = QPushButton("Profile next evaluation", self.profileTab)
+        self.profileButton.setCheckable(True)
+        layout.addWidget(self.profileButton)
+        self.profileText = QTextEdit(self.profileTab)
+        self.profileText.setReadOnly(True)
+        self.profileText.setLineWrapMode(QTextEdit.NoWrap)
+        self.profileText.setFontFamily("monospace")
+        layout.addWidget(self.profileText)
+        self.saveProfileButton = QPushButton("Save pstats file...", self.profileTab)
+        self.saveProfileButton.setEnabled(False)
+        layout.addWidget(self.saveProfileButton)
+        self.tabWidget.addTab(self.profileTab, "Profile")
+
+    def setupWarmupTab(self):
+        tab = QWidget()
+        layout = QVBoxLayout(tab)
+        self.warmupLayerComboBox = QgsMapLayerComboBox(tab)
+        self.warmupLayerComboBox.setFilters(QgsMapLayerProxyModel.VectorLayer)
+        layout.addWidget(self.warmupLayerComboBox)
+        self.warmupSpatialCheckBox = QCheckBox("Spatial index (geom... functions)", tab)
+        self.warmupSpatialCheckBox.setChecked(True)
+        layout.addWidget(self.warmupSpatialCheckBox)
+        layout.addWidget(QLabel("Key fields (dbvalue):", tab))
+        self.warmupFieldsList = QListWidget(tab)
+        layout.addWidget(self.warmupFieldsList)
+        self.warmupButton = QPushButton("Build indexes in background", tab)
+        layout.addWidget(self.warmupButton)
+        self.warmupLabel = QLabel(tab)
+        layout.addWidget(self.warmupLabel)
+        self.warmupLayerComboBox.layerChanged.connect(self.showWarmupFields)
+        self.showWarmupFields(self.warmupLayerComboBox.currentLayer())
+        self.tabWidget.addTab(tab, "Warm-up")
+
+    def showWarmupFields(self, layer):
+        self.warmupFieldsList.clear()
+        if layer is None:
+            return
+        for field in layer.fields():
+            item = QListWidgetItem(field.name(), self.warmupFieldsList)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked)
+
+    def warmupFields(self):
+        items = (self.warmupFieldsList.item(row) for row in range(self.warmupFieldsList.count()))
+        return [item.text() for item in items if item.checkState() == Qt.Checked]
+
+    def showProfile(self, report):
+        self.profileText.setPlainText(report)
+
+    def showStatistics(self, report):
+        functions = report["functions"]
+        self.statisticsTable.setRowCount(len(functions))
+        self.statisticsTable.setVerticalHeaderLabels(list(functions.keys()))
+        for row, stats in enumerate(functions.values()):
+            for column, key in enumerate(STATISTICS_COLUMNS):
+                value = stats[key]
+                self.statisticsTable.setItem(row, column, QTableWidgetItem("%.3f" % value if isinstance(value, float) else str(value)))
+        self.cachesLabel.setText("  ".join("%s cache: %d hits, %d misses (%.0f%%)" % (name, cache["hits"], cache["misses"], cache["hit_rate"] * 100)
+                                           for name, cache in report["caches"].items()))
+        memory = report["memory"]
+        budget = "%.1f MB budget" % (memory["budget"] / 1048576.0) if memory["budget"] else "no budget"
+        self.memoryLabel.setText("memory: %.1f MB (%s), %s, %d evictions" % (
+            memory["total"] / 1048576.0, budget,
+            ", ".join("%s %.1f MB" % (kind, size / 1048576.0) for kind, size in sorted(memory["usage"].items())),
+            memory["evictions"]))
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ReferenceFunctions processing provider
+                                 A QGIS plugin
+ Provide field calculator function for Reference to other layers/features
+                              -------------------
+ Reference joins algorithms, built on the indexes used by the expression
+ functions: the target features are read once, the source features are
+ processed in chunks shared between threads. Spatial joins may instead
+ stream through tiles of the source extent to run in bounded memory.
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import sys
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from qgis.PyQt.QtCore import QVariant, QThread
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (QgsProcessingProvider, QgsProcessingAlgorithm, QgsProcessing, QgsProcessingException,
+                       QgsProcessingParameterFeatureSource, QgsProcessingParameterField, QgsProcessingParameterEnum,
+                       QgsProcessingParameterNumber, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSink,
+                       QgsFeature, QgsFeatureSink, QgsFeatureRequest, QgsField, QgsFields, QgsRectangle)
+
+from .reffunctions import targetIndex, keyIndex, fieldReference, _matchingIds, _collectValues, _CONVERSE
+
+CHUNK_SIZE = 1000
+
+
+class refFunctionsProvider(QgsProcessingProvider):
+
+    def id(self):
+        return "reffunctions"
+
+    def name(self):
+        return "refFunctions"
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), "icon.png"))
+
+    def loadAlgorithms(self):
+        for algorithm in (attributeLookupJoin, spatialPredicateJoin, nearestJoin, zonalCountSum):
+            self.addAlgorithm(algorithm())
+
+
+# errors of _collectValues, reported instead of an expression eval error
+class _errorCollector:
+
+    def __init__(self):
+        self.error = None
+
+    def setEvalErrorString(self, error):
+        self.error = error
+
+
+def _uniqueField(fields, name, fieldType):
+    fieldName = name
+    suffix = 2
+    while fields.indexOf(fieldName) >= 0:
+        fieldName = "%s_%d" % (name, suffix)
+        suffix += 1
+    return QgsField(fieldName, fieldType)
+
+
+class referenceJoinAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = "INPUT"
+    TARGET = "TARGET"
+    TARGET_FIELD = "TARGET_FIELD"
+    THREADS = "THREADS"
+    TILE_SIZE = "TILE_SIZE"
+    OUTPUT = "OUTPUT"
+
+    def group(self):
+        return "Reference joins"
+
+    def groupId(self):
+        return "referencejoins"
+
+    def createInstance(self):
+        return type(self)()
+
+    def addSourceParameters(self, inputTypes=(QgsProcessing.TypeVectorAnyGeometry,)):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, "Source layer", list(inputTypes)))
+        self.addParameter(QgsProcessingParameterFeatureSource(self.TARGET, "Target layer", [QgsProcessing.TypeVector]))
+
+    def addCommonParameters(self):
+        threads = QgsProcessingParameterNumber(self.THREADS, "Threads", QgsProcessingParameterNumber.Integer, max(QThread.idealThreadCount(), 1), False, 1)
+        threads.setFlags(threads.flags() | threads.FlagAdvanced)
+        self.addParameter(threads)
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "Joined layer"))
+
+    def addTileParameter(self):
+        tileSize = QgsProcessingParameterDistance(self.TILE_SIZE, "Tile size, 0 to read all the target features at once", 0, self.INPUT, False, 0)
+        tileSize.setFlags(tileSize.flags() | tileSize.FlagAdvanced)
+        self.addParameter(tileSize)
+
+    def targetRequest(self, parameters, context):
+        """Request reading the target features in the source CRS, without geometry when not used"""
+        if not self.usesGeometry():
+            return QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        request = QgsFeatureRequest()
+        if source is not None:
+            request.setDestinationCrs(source.sourceCrs(), context.transformContext())
+        return request
+
+    def readTargets(self, parameters, context, feedback):
+        """Target features by id, None when canceled"""
+        target = self.parameterAsSource(parameters, self.TARGET, context)
+        if target is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.TARGET))
+        feedback.pushInfo("Reading target features")
+        targets = {}
+        for feat in target.getFeatures(self.targetRequest(parameters, context)):
+            if feedback.isCanceled():
+                return None
+            targets[feat.id()] = feat
+        return targets
+
+    def createSink(self, parameters, context, joinFields):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        fields = QgsFields(source.fields())
+        for field in joinFields:
+            fields.append(_uniqueField(fields, field.name(), field.type()))
+        (sink, destId) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, source.wkbType(), source.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        return source, sink, destId, fields
+
+    def writeChunk(self, executor, threads, chunk, evaluate, sink, fields, width):
+        """Evaluate a chunk of source features in slices shared between threads and write them"""
+        evaluateSlice = lambda feats: [evaluate(feat) if feat.hasGeometry() or not self.usesGeometry() else [None] * width for feat in feats]
+        step = -(-len(chunk) // threads)
+        slices = [chunk[i:i + step] for i in range(0, len(chunk), step)]
+        for feats, results in zip(slices, executor.map(evaluateSlice, slices)):
+            for joinFeat, attributes in zip(feats, results):
+                out = QgsFeature(fields)
+                out.setGeometry(joinFeat.geometry())
+                out.setAttributes(joinFeat.attributes() + attributes)
+                sink.addFeature(out, QgsFeatureSink.FastInsert)
+
+    def joinFeatures(self, parameters, context, feedback, joinFields, evaluate):
+        """Write source features with the attributes returned by evaluate, run on chunks shared between threads"""
+        source, sink, destId, fields = self.createSink(parameters, context, joinFields)
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
+        total = source.featureCount() or 1
+        done = 0
+        chunk = []
+        iterator = source.getFeatures()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                feat = next(iterator, None)
+                if feat is not None:
+                    chunk.append(QgsFeature(feat))
+                    if len(chunk) < CHUNK_SIZE:
+                        continue
+                if chunk:
+                    self.writeChunk(executor, threads, chunk, evaluate, sink, fields, len(joinFields))
+                    done += len(chunk)
+                    chunk = []
+                    feedback.setProgress(done * 100 / total)
+                if feat is None or feedback.isCanceled():
+                    break
+        return {self.OUTPUT: destId}
+
+    def tiled(self, parameters, context):
+        return self.parameterAsDouble(parameters, self.TILE_SIZE, context) > 0
+
+    def joinTiles(self, parameters, context, feedback, joinFields, makeEvaluate, margin=0.0):
+        """
+        Same as joinFeatures streaming through square tiles of the source extent. Each tile holds the
+        source features whose bounding box center falls in it, so that every source feature is written
+        once, and the target features within margin of their bounding boxes, indexed for this tile only.
+        makeEvaluate(targets, tIndex) returns the evaluate function of a tile.
+        """
+        source, sink, destId, fields = self.createSink(parameters, context, joinFields)
+        target = self.parameterAsSource(parameters, self.TARGET, context)
+        if target is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.TARGET))
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
+        tileSize = self.parameterAsDouble(parameters, self.TILE_SIZE, context)
+        extent = source.sourceExtent()
+        columns = max(int(math.ceil(extent.width() / tileSize)), 1)
+        rows = max(int(math.ceil(extent.height() / tileSize)), 1)
+        tileOf = lambda point: (min(int((point.x() - extent.xMinimum()) / tileSize), columns - 1),
+                                min(int((point.y() - extent.yMinimum()) / tileSize), rows - 1))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for tile in range(columns * rows):
+                if feedback.isCanceled():
+                    break
+                column, row = tile % columns, tile // columns
+                x = extent.xMinimum() + column * tileSize
+                y = extent.yMinimum() + row * tileSize
+                request = QgsFeatureRequest().setFilterRect(QgsRectangle(x, y, x + tileSize, y + tileSize))
+                chunk = []
+                bounds = QgsRectangle()
+                for feat in source.getFeatures(request):
+                    if feat.hasGeometry() and tileOf(feat.geometry().boundingBox().center()) == (column, row):
+                        chunk.append(QgsFeature(feat))
+                        bounds.combineExtentWith(feat.geometry().boundingBox())
+                if chunk:
+                    request = self.targetRequest(parameters, context).setFilterRect(bounds.buffered(margin))
+                    targets = {feat.id(): feat for feat in target.getFeatures(request)}
+                    evaluate = makeEvaluate(targets, targetIndex(None, targets.values()))
+                    for i in range(0, len(chunk), CHUNK_SIZE):
+                        self.writeChunk(executor, threads, chunk[i:i + CHUNK_SIZE], evaluate, sink, fields, len(joinFields))
+                feedback.setProgress((tile + 1) * 100 / (columns * rows))
+        # source features without geometry are in no tile
+        for feat in source.getFeatures(QgsFeatureRequest().setFilterExpression("$geometry IS NULL")):
+            out = QgsFeature(fields)
+            out.setAttributes(feat.attributes() + [None] * len(joinFields))
+            sink.addFeature(out, QgsFeatureSink.FastInsert)
+        return {self.OUTPUT: destId}
+
+    def usesGeometry(self):
+        return True
+
+
+class attributeLookupJoin(referenceJoinAlgorithm):
+
+    INPUT_FIELD = "INPUT_FIELD"
+    TARGET_KEY = "TARGET_KEY"
+
+    def name(self):
+        return "attributelookupjoin"
+
+    def displayName(self):
+        return "Attribute lookup join"
+
+    def shortHelpString(self):
+        return "Join to each source feature the target_field value of the first target feature whose key field is equal to the source field, as dbvalue() does."
+
+    def initAlgorithm(self, config=None):
+        self.addSourceParameters((QgsProcessing.TypeVector,))
+        self.addParameter(QgsProcessingParameterField(self.INPUT_FIELD, "Source field", None, self.INPUT))
+        self.addParameter(QgsProcessingParameterField(self.TARGET_KEY, "Target key field", None, self.TARGET))
+        self.addParameter(QgsProcessingParameterField(self.TARGET_FIELD, "Target field", None, self.TARGET))
+        self.addCommonParameters()
+
+    def usesGeometry(self):
+        return False
+
+    def processAlgorithm(self, parameters, context, feedback):
+        inputField = self.parameterAsString(parameters, self.INPUT_FIELD, context)
+        keyField = self.parameterAsString(parameters, self.TARGET_KEY, context)
+        targetField = self.parameterAsString(parameters, self.TARGET_FIELD, context)
+        targets = self.readTargets(parameters, context, feedback)
+        if targets is None:
+            return {}
+        kIndex = keyIndex(None, keyField, targets.values())
+        fieldType = QVariant.String
+        for feat in targets.values():
+            fieldType = feat.fields().field(targetField).type()
+            break
+
+        def evaluate(feat):
+            fid = kIndex.get(feat.attribute(inputField))
+            return [targets[fid].attribute(targetField) if fid is not None else None]
+
+        return self.joinFeatures(parameters, context, feedback, [QgsField(targetField, fieldType)], evaluate)
+
+
+class spatialPredicateJoin(referenceJoinAlgorithm):
+
+    PREDICATE = "PREDICATE"
+    PREDICATES = ["intersects", "within", "contains", "touches", "crosses", "overlaps", "equals", "disjoint"]
+
+    def name(self):
+        return "spatialpredicatejoin"
+
+    def displayName(self):
+        return "Spatial predicate join"
+
+    def shortHelpString(self):
+        return "Join to each source feature the unique target_field values, separated by |, of the target features verifying the predicate, as geomwithin(), geomintersects()... do. Without target field the ids of all these target features are joined, separated by |."
+
+    def initAlgorithm(self, config=None):
+        self.addSourceParameters()
+        self.addParameter(QgsProcessingParameterEnum(self.PREDICATE, "Source feature predicate target feature", self.PREDICATES, False, 0))
+        self.addParameter(QgsProcessingParameterField(self.TARGET_FIELD, "Target field", None, self.TARGET, optional=True))
+        self.addTileParameter()
+        self.addCommonParameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        predic = self.PREDICATES[self.parameterAsEnum(parameters, self.PREDICATE, context)]
+        targetField = self.parameterAsString(parameters, self.TARGET_FIELD, context) or "$id"
+        reference = fieldReference(self.parameterAsSource(parameters, self.TARGET, context).fields(), targetField)
+        joinFields = [QgsField(targetField.replace("$", ""), QVariant.String)]
+
+        def makeEvaluate(targets, tIndex):
+            def evaluate(feat):
+                geom = feat.geometry()
+                # a feature without geometry verifies no predicate
+                if geom.isNull():
+                    return [None]
+                fids = _matchingIds(None, tIndex, geom, "intersects" if predic == "disjoint" else predic)
+                if predic == "disjoint":
+                    fids = tIndex.disjointIds(set(fids))
+                # all the ids are joined, formatted as the attribute values
+                if reference.isId:
+                    return [" | ".join(str(fid) for fid in sorted(fids)) or None]
+                collector = _errorCollector()
+                value = _collectValues([targets[fid] for fid in sorted(fids)], reference, collector)
+                if collector.error:
+                    raise QgsProcessingException(collector.error)
+                return [str(value) if value != "" else None]
+            return evaluate
+
+        if self.tiled(parameters, context):
+            # disjoint features are not around the source features
+            if predic == "disjoint":
+                raise QgsProcessingException("The disjoint predicate can not be evaluated by tiles")
+            return self.joinTiles(parameters, context, feedback, joinFields, makeEvaluate)
+        targets = self.readTargets(parameters, context, feedback)
+        if targets is None:
+            return {}
+        return self.joinFeatures(parameters, context, feedback, joinFields, makeEvaluate(targets, targetIndex(None, targets.values())))
+
+
+class nearestJoin(referenceJoinAlgorithm):
+
+    MAX_DISTANCE = "MAX_DISTANCE"
+
+    def name(self):
+        return "nearestjoin"
+
+    def displayName(self):
+        return "Nearest join"
+
+    def shortHelpString(self):
+        return "Join to each source feature the target_field value of the nearest target feature and its distance, as geomnearest() and geomdistance() do. A maximum distance of 0 means no limit."
+
+    def initAlgorithm(self, config=None):
+        self.addSourceParameters()
+        self.addParameter(QgsProcessingParameterField(self.TARGET_FIELD, "Target field", None, self.TARGET))
+        self.addParameter(QgsProcessingParameterDistance(self.MAX_DISTANCE, "Maximum distance", 0, self.INPUT, False, 0))
+        self.addTileParameter()
+        self.addCommonParameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        targetField = self.parameterAsString(parameters, self.TARGET_FIELD, context)
+        maxDistance = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        target = self.parameterAsSource(parameters, self.TARGET, context)
+        fieldType = target.fields().field(targetField).type() if target is not None else QVariant.String
+        joinFields = [QgsField(targetField, fieldType), QgsField("distance", QVariant.Double)]
+
+        def makeEvaluate(targets, tIndex):
+            def evaluate(feat):
+                geom = feat.geometry()
+                if maxDistance > 0:
+                    fids = tIndex.candidates(geom.boundingBox().buffered(maxDistance))
+                else:
+                    fids = tIndex.nearestCandidates(None, geom)
+                dmin = sys.float_info.max
+                nearest = None
+                for fid, targetGeom in tIndex.geometries(None, sorted(fids)).items():
+                    dtest = geom.distance(targetGeom)
+                    if dtest < dmin and (maxDistance <= 0 or dtest <= maxDistance):
+                        dmin = dtest
+                        nearest = fid
+                if nearest is None:
+                    return [None, None]
+                return [targets[nearest].attribute(targetField), dmin]
+            return evaluate
+
+        if self.tiled(parameters, context):
+            # the nearest feature is only known to be in the tile within a maximum distance
+            if maxDistance <= 0:
+                raise QgsProcessingException("A maximum distance is required to join by tiles")
+            return self.joinTiles(parameters, context, feedback, joinFields, makeEvaluate, maxDistance)
+        targets = self.readTargets(parameters, context, feedback)
+        if targets is None:
+            return {}
+        return self.joinFeatures(parameters, context, feedback, joinFields, makeEvaluate(targets, targetIndex(None, targets.values())))
+
+
+class zonalCountSum(referenceJoinAlgorithm):
+
+    PREDICATE = "PREDICATE"
+    PREDICATES = ["intersects", "within", "overlaps", "equals"]
+    SUM_FIELD = "SUM_FIELD"
+
+    def name(self):
+        return "zonalcountsum"
+
+    def displayName(self):
+        return "Zonal count/sum"
+
+    def shortHelpString(self):
+        return "Count the target features verifying the predicate against each source feature, and sum their sum_field values, as the ..._geom_count and ..._geom_sum functions do."
+
+    def initAlgorithm(self, config=None):
+        self.addSourceParameters()
+        self.addParameter(QgsProcessingParameterEnum(self.PREDICATE, "Target feature predicate source feature", self.PREDICATES, False, 0))
+        self.addParameter(QgsProcessingParameterField(self.SUM_FIELD, "Field to sum", None, self.TARGET, QgsProcessingParameterField.Numeric, optional=True))
+        self.addTileParameter()
+        self.addCommonParameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        predic = self.PREDICATES[self.parameterAsEnum(parameters, self.PREDICATE, context)]
+        if predic == "equals":
+            predic = "isGeosEqual"
+        sumField = self.parameterAsString(parameters, self.SUM_FIELD, context)
+        joinFields = [QgsField("count", QVariant.LongLong), QgsField("sum", QVariant.Double)]
+
+        def makeEvaluate(targets, tIndex):
+            def evaluate(feat):
+                fids = _matchingIds(None, tIndex, feat.geometry(), _CONVERSE.get(predic, predic))
+                total = 0.0
+                if sumField:
+                    for fid in fids:
+                        try:
+                            total += float(targets[fid].attribute(sumField))
+                        except:
+                            #case value is null or string....
+                            pass
+                return [len(fids), total]
+            return evaluate
+
+        if self.tiled(parameters, context):
+            return self.joinTiles(parameters, context, feedback, joinFields, makeEvaluate)
+        targets = self.readTargets(parameters, context, feedback)
+        if targets is None:
+            return {}
+        return self.joinFeatures(parameters, context, feedback, joinFields, makeEvaluate(targets, targetIndex(None, targets.values())))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Index cache entries are reloaded only while the files of the dataset are
+unchanged. Runs with the QGIS Python bindings available:
+
+   python -m pytest test
+"""
+import os
+import tempfile
+import unittest
+
+try:
+    from ..reffunctions import indexStore
+except ImportError:
+    indexStore = None
+
+
+# layer state as seen by the index store
+class _state:
+
+    def __init__(self, store, path):
+        self.source = path
+        self.subsetString = ""
+        self.stamp = store._fileStamp(path)
+
+
+@unittest.skipIf(indexStore is None, "QGIS Python bindings not available")
+class indexStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cache = os.path.join(self.tmp.name, "cache")
+        self.store = indexStore()
+        self.store.directory = lambda: cache
+        self.shp = os.path.join(self.tmp.name, "layer.shp")
+        for ext, data in ((".shp", b"shapes"), (".shx", b"index"), (".dbf", b"attributes")):
+            with open(os.path.join(self.tmp.name, "layer" + ext), "wb") as f:
+                f.write(data)
+
+    def _touch(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        # later modification time even on coarse file systems
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_keys_reloaded_while_unchanged(self):
+        ids = {"a": 1, "b": 2, 3: 4, 1.5: 5, True: 6}
+        self.store.saveKeys(_state(self.store, self.shp), "key", ids)
+        self.assertEqual(self.store.loadKeys(_state(self.store, self.shp), "key"), ids)
+
+    def test_attribute_change_invalidates(self):
+        self.store.saveKeys(_state(self.store, self.shp), "key", {"a": 1})
+        self._touch("layer.dbf", b"other attributes")
+        self.assertIsNone(self.store.loadKeys(_state(self.store, self.shp), "key"))
+
+    def test_sidecar_change_invalidates(self):
+        self.store.saveKeys(_state(self.store, self.shp), "key", {"a": 1})
+        self._touch("layer.cpg", b"UTF-8")
+        self.assertIsNone(self.store.loadKeys(_state(self.store, self.shp), "key"))
+
+    def test_write_ahead_log_change_invalidates(self):
+        gpkg = os.path.join(self.tmp.name, "data.gpkg")
+        self._touch("data.gpkg", b"database")
+        self.store.saveKeys(_state(self.store, gpkg), "key", {"a": 1})
+        self._touch("data.gpkg-wal", b"commit")
+        self.assertIsNone(self.store.loadKeys(_state(self.store, gpkg), "key"))
+
+    def test_other_dataset_ignored(self):
+        self.store.saveKeys(_state(self.store, self.shp), "key", {"a": 1})
+        self._touch("other.dbf", b"attributes")
+        self.assertEqual(self.store.loadKeys(_state(self.store, self.shp), "key"), {"a": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()